@@ -12,9 +12,12 @@
     'demo': [
     ],
     'data': [
+        'security/ir.model.access.csv',
         'views/stock_quant_views.xml',
         'views/stock_move_views.xml',
         'views/stock_picking_views.xml',
+        'views/package_hierarchy_browser_views.xml',
+        'views/package_hierarchy_stat_views.xml',
     ],
     'qweb': [
     ],
@@ -1,3 +1,9 @@
+from . import package_hierarchy_browser
+from . import package_hierarchy_stat
+from . import stock_move
 from . import stock_move_line
 from . import stock_picking
-from . import stock_quant_package
\ No newline at end of file
+from . import stock_picking_type
+from . import stock_quant
+from . import stock_quant_package
+from . import stock_quant_package_content
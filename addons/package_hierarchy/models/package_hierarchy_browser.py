@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""Paginated browsing of the content of a package, one level at a time."""
+
+from odoo import api, fields, models
+
+
+class PackageHierarchyBrowser(models.TransientModel):
+    """ One page of the packages and quants directly contained in a package,
+        as returned by stock.quant.package.get_children_page.
+    """
+    _name = 'package.hierarchy.browser'
+    _description = 'Package Content'
+    _rec_name = 'package_id'
+
+    package_id = fields.Many2one('stock.quant.package', 'Package',
+                                 required=True, readonly=True)
+    parent_package_id = fields.Many2one(related='package_id.package_id',
+                                        readonly=True)
+    offset = fields.Integer('Offset', readonly=True)
+    limit = fields.Integer('Page Size', default=80, readonly=True)
+    child_count = fields.Integer('Child Packages', readonly=True)
+    direct_quant_count = fields.Integer('Direct Quants', readonly=True)
+    quant_count = fields.Integer('All Quants', readonly=True)
+    descendant_count = fields.Integer('All Contained Packages', readonly=True)
+    line_ids = fields.One2many('package.hierarchy.browser.line', 'browser_id',
+                               'Content', readonly=True)
+    has_previous = fields.Boolean(compute='_compute_has_pages')
+    has_next = fields.Boolean(compute='_compute_has_pages')
+
+    @api.depends('offset', 'limit', 'child_count', 'direct_quant_count')
+    def _compute_has_pages(self):
+        for browser in self:
+            total = browser.child_count + browser.direct_quant_count
+            browser.has_previous = browser.offset > 0
+            browser.has_next = browser.offset + browser.limit < total
+
+    @api.model
+    def open_package(self, package_id, limit=80):
+        """ Open the first page of the content of a package. """
+        browser = self.create({'package_id': package_id, 'limit': limit})
+        browser._load_page(0)
+        return browser._get_action()
+
+    def _load_page(self, offset):
+        """ Replace the lines with the page of content starting at offset. """
+        self.ensure_one()
+        page = self.package_id.get_children_page(offset=offset, limit=self.limit)
+        lines = [(5, 0, 0)]
+        for child in page['children']:
+            lines.append((0, 0, {
+                'child_package_id': child['id'],
+                'location_id': child['location_id'] and child['location_id'][0],
+                'quant_count': child['u_quant_count'],
+                'descendant_count': child['u_descendant_count'],
+            }))
+        for quant in page['quants']:
+            lines.append((0, 0, {
+                'product_id': quant['product_id'] and quant['product_id'][0],
+                'lot_id': quant['lot_id'] and quant['lot_id'][0],
+                'quantity': quant['quantity'],
+                'product_uom_id': quant['product_uom_id'] and quant['product_uom_id'][0],
+            }))
+        self.write({
+            'offset': offset,
+            'child_count': page['child_count'],
+            'direct_quant_count': page['direct_quant_count'],
+            'quant_count': page['quant_count'],
+            'descendant_count': page['descendant_count'],
+            'line_ids': lines,
+        })
+
+    def _get_action(self):
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': self.package_id.display_name,
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'current',
+        }
+
+    def action_next_page(self):
+        self.ensure_one()
+        self._load_page(self.offset + self.limit)
+        return self._get_action()
+
+    def action_previous_page(self):
+        self.ensure_one()
+        self._load_page(max(self.offset - self.limit, 0))
+        return self._get_action()
+
+    def action_parent(self):
+        """ Open the first page of the content of the parent package. """
+        self.ensure_one()
+        return self.open_package(self.parent_package_id.id, limit=self.limit)
+
+
+class PackageHierarchyBrowserLine(models.TransientModel):
+    """ A child package or a direct quant of the browsed package. """
+    _name = 'package.hierarchy.browser.line'
+    _description = 'Package Content Line'
+
+    browser_id = fields.Many2one('package.hierarchy.browser', required=True,
+                                 ondelete='cascade')
+    child_package_id = fields.Many2one('stock.quant.package', 'Package',
+                                       readonly=True)
+    location_id = fields.Many2one('stock.location', 'Location', readonly=True)
+    quant_count = fields.Integer('Quants', readonly=True)
+    descendant_count = fields.Integer('Contained Packages', readonly=True)
+    product_id = fields.Many2one('product.product', 'Product', readonly=True)
+    lot_id = fields.Many2one('stock.production.lot', 'Lot/Serial Number',
+                             readonly=True)
+    quantity = fields.Float('Quantity', readonly=True)
+    product_uom_id = fields.Many2one('product.uom', 'Unit of Measure',
+                                     readonly=True)
+
+    def action_expand(self):
+        """ Open the first page of the content of the child package. """
+        self.ensure_one()
+        return self.env['package.hierarchy.browser'].open_package(
+            self.child_package_id.id, limit=self.browser_id.limit)
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Opt-in instrumentation of the package hierarchy methods."""
+
+import functools
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# System parameter and context key enabling the instrumentation
+INSTRUMENTATION_PARAM = 'package_hierarchy.instrumentation'
+INSTRUMENTATION_CONTEXT_KEY = 'package_hierarchy_instrumentation'
+
+# [calls, seconds, queries, records] per (database, method), for this process
+_stats = defaultdict(lambda: [0, 0.0, 0, 0])
+_stats_lock = threading.Lock()
+
+
+def _instrumentation_enabled(records):
+    if records.env.context.get(INSTRUMENTATION_CONTEXT_KEY):
+        return True
+    # get_param is cached, so this does not query the database on each call
+    return bool(records.env['ir.config_parameter'].sudo().get_param(INSTRUMENTATION_PARAM))
+
+
+def instrumented(method):
+    """ Record the calls, wall time, number of queries and number of
+        records of method when the instrumentation is enabled. Nested
+        instrumented calls are included in the figures of their caller.
+
+        It has to be the innermost decorator of method, so that the Odoo
+        api decorators apply to the instrumented method.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if not _instrumentation_enabled(self):
+            return method(self, *args, **kwargs)
+        cr = self.env.cr
+        queries = cr.sql_log_count
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            duration = time.time() - start
+            queries = cr.sql_log_count - queries
+            name = '%s.%s' % (self._name, method.__name__)
+            with _stats_lock:
+                stat = _stats[cr.dbname, name]
+                stat[0] += 1
+                stat[1] += duration
+                stat[2] += queries
+                stat[3] += len(self)
+            _logger.info('%s: %d records, %.3fs, %d queries',
+                         name, len(self), duration, queries)
+    return wrapper
+
+
+class PackageHierarchyStat(models.TransientModel):
+    """ Summary of the instrumented package hierarchy methods called in
+        this server process.
+    """
+    _name = 'package.hierarchy.stat'
+    _description = 'Package Hierarchy Statistics'
+    _order = 'total_time desc'
+
+    method = fields.Char('Method', readonly=True)
+    call_count = fields.Integer('Calls', readonly=True)
+    total_time = fields.Float('Total Time (s)', digits=(16, 3), readonly=True)
+    average_time = fields.Float('Average Time (s)', digits=(16, 3), readonly=True)
+    query_count = fields.Integer('Queries', readonly=True)
+    record_count = fields.Integer('Records', readonly=True)
+
+    @api.model
+    def action_view_stats(self):
+        """ Snapshot the statistics of the current database and open them. """
+        dbname = self._cr.dbname
+        with _stats_lock:
+            stats = [(name, list(stat)) for (db, name), stat in _stats.items()
+                     if db == dbname]
+        self.search([('create_uid', '=', self._uid)]).unlink()
+        for name, (calls, seconds, queries, records) in stats:
+            self.create({
+                'method': name,
+                'call_count': calls,
+                'total_time': seconds,
+                'average_time': seconds / calls,
+                'query_count': queries,
+                'record_count': records,
+            })
+        return {
+            'type': 'ir.actions.act_window',
+            'name': self._description,
+            'res_model': self._name,
+            'view_mode': 'tree',
+            'target': 'current',
+        }
+
+    @api.model
+    def action_reset_stats(self):
+        """ Forget the statistics of the current database. """
+        dbname = self._cr.dbname
+        with _stats_lock:
+            for key in [key for key in _stats if key[0] == dbname]:
+                del _stats[key]
+        return self.action_view_stats()
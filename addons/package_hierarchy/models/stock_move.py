@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models
+
+
+class StockMove(models.Model):
+    _inherit = 'stock.move'
+
+    def _update_reserved_quantity(self, need, available_quantity, location_id,
+                                  lot_id=None, package_id=None, owner_id=None,
+                                  strict=True):
+        """ Reserve whole packages first when the picking type asks for it. """
+        if self.picking_type_id.u_reserve_whole_packages and not package_id:
+            self = self.with_context(reserve_whole_packages=True)
+        return super(StockMove, self)._update_reserved_quantity(
+            need, available_quantity, location_id, lot_id=lot_id,
+            package_id=package_id, owner_id=owner_id, strict=strict)
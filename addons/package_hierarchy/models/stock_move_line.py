@@ -1,8 +1,13 @@
 # -*- coding: utf-8 -*-
 
+from collections import defaultdict
+
 from odoo import api, models, fields, _
 from odoo.exceptions import ValidationError
 
+from .package_hierarchy_stat import instrumented
+from .stock_quant_package import split_batches
+
 
 class StockMoveLine(models.Model):
     _inherit = 'stock.move.line'
@@ -10,27 +15,79 @@ class StockMoveLine(models.Model):
     u_result_parent_package_id = fields.Many2one('stock.quant.package',
                     'Parent Destination Package', ondelete='restrict')
 
+    @instrumented
     def _action_done(self):
         """ When a move_line is done and it has result_package_id its
             parent will be removed if u_result_parent_package_id is empty,
             otherwise it will be updated to be u_result_parent_package_id.
         """
         super(StockMoveLine, self)._action_done()
-        for ml in self.exists():
+        self.exists()._set_result_package_parents()
+
+    @instrumented
+    def _set_result_package_parents(self):
+        """ Move the result packages of self into their result parent
+            package, or out of their parent package if they have none.
+
+            The move lines are processed in batches of root packages, see
+            _get_root_package_batches, with the hierarchy of each tree
+            validated once at the end.
+        """
+        Package = self.env['stock.quant.package']
+        with Package._deferred_hierarchy_checks():
+            for index, batch in enumerate(self._get_root_package_batches()):
+                if index:
+                    self.env.invalidate_all()
+                batch._set_result_package_parents_batch()
+
+    def _set_result_package_parents_batch(self):
+        """ The final parent of every result package is computed first,
+            then packages are written once per target parent.
+        """
+        Package = self.env['stock.quant.package']
+        parent_by_package = {}
+        for ml in self:
             result_parent = ml.u_result_parent_package_id
             result_package = ml.result_package_id
-            if result_parent:
-                if result_package:
-                    # only update if it is different
-                    if result_package.package_id != result_parent:
-                        result_package.package_id = result_parent
-                else:
-                    raise ValidationError(
-                            _('Result parent package without result'
-                              ' package at picking %s') % ml.picking_id.name)
-            else:
-                if result_package and result_package.package_id:
-                    result_package.package_id = False
+            if result_package:
+                parent_by_package[result_package] = result_parent
+            elif result_parent:
+                raise ValidationError(
+                        _('Result parent package without result'
+                          ' package at picking %s') % ml.picking_id.name)
+
+        package_ids_by_parent = defaultdict(list)
+        for result_package, result_parent in parent_by_package.items():
+            # only update if it is different
+            if result_package.package_id != result_parent:
+                package_ids_by_parent[result_parent.id].append(result_package.id)
+        for parent_id, package_ids in package_ids_by_parent.items():
+            Package.browse(package_ids).write({'package_id': parent_id})
+
+    def _get_root_package_batches(self):
+        """ Split self in batches of move lines to bound the memory used
+            by the hierarchy post-processing of large pickings.
+
+            The move lines of a same root package, the one of their result
+            package or else of their package, are kept in the same batch so
+            that the result is the same as processing self at once.
+        """
+        batch_size = self.env['stock.quant.package']._get_hierarchy_batch_size()
+        if not batch_size or len(self) <= batch_size:
+            return [self]
+        self._cr.execute("""
+            SELECT COALESCE(split_part(COALESCE(result_package.parent_path,
+                                                package.parent_path), '/', 1),
+                            'line' || ml.id),
+                   ml.id
+            FROM stock_move_line ml
+            LEFT JOIN stock_quant_package result_package
+                ON result_package.id = ml.result_package_id
+            LEFT JOIN stock_quant_package package ON package.id = ml.package_id
+            WHERE ml.id IN %s
+            ORDER BY 1, 2
+        """, (tuple(self.ids),))
+        return [self.browse(ids) for ids in split_batches(self._cr.fetchall(), batch_size)]
 
     @api.onchange('result_package_id')
     def onchange_result_package(self):
@@ -45,17 +102,26 @@ class StockMoveLine(models.Model):
     def _assert_one_parent_package(self):
         """ Checks that there is only one parent package per result_package_id
             and that there is result_package_id
+
+            The move lines of each picking are grouped by result package in
+            a single pass, whatever the number of move lines checked.
         """
-        for ml in self:
-            result_parent = ml.u_result_parent_package_id
-            if result_parent:
-                result_package = ml.result_package_id
-                if not result_package:
-                    raise ValidationError(_('Cannot set result parent package to a move line without result package.'))
-                # get lines with the same result_package_id that have u_result_parent_package_id
-                lines = ml.picking_id.mapped('move_line_ids').filtered(lambda l: l.result_package_id == result_package and
-                                                                                 l.u_result_parent_package_id)
-                parents = lines.mapped('u_result_parent_package_id')
+        Package = self.env['stock.quant.package']
+        result_packages = set()
+        for ml in self.filtered('u_result_parent_package_id'):
+            if not ml.result_package_id:
+                raise ValidationError(_('Cannot set result parent package to a move line without result package.'))
+            result_packages.add(ml.result_package_id)
+        if not result_packages:
+            return
+        for picking in self.mapped('picking_id'):
+            # get result parents of the lines with the same result_package_id
+            parents_by_package = defaultdict(lambda: Package.browse())
+            for line in picking.move_line_ids:
+                result_package = line.result_package_id
+                if line.u_result_parent_package_id and result_package in result_packages:
+                    parents_by_package[result_package] |= line.u_result_parent_package_id
+            for result_package, parents in parents_by_package.items():
                 if len(parents) > 1:
                     raise ValidationError(
                             _('Multiple result parent packages for package %s found %s.') %
@@ -1,45 +1,82 @@
+from collections import defaultdict
+
 from odoo import fields, models, _
 from odoo.exceptions import UserError
 
+from .package_hierarchy_stat import instrumented
+
 
 class StockPicking(models.Model):
     _inherit = "stock.picking"
 
+    @instrumented
     def _compute_entire_package_ids(self):
-        """Add parent packages to picking."""
+        """Add parent packages to picking, up to the highest ancestor whose
+        contents are entirely in the picking."""
         super(StockPicking, self)._compute_entire_package_ids()
 
+        Package = self.env["stock.quant.package"]
         for picking in self:
-            packages = self.env["stock.quant.package"]
             current_packages = picking.entire_package_detail_ids | picking.entire_package_ids
-
-            for package in current_packages:
-                parent_pack = package.package_id
-                if parent_pack and parent_pack.is_all_contents_in(current_packages):
-                    packages |= parent_pack
+            packages = Package.browse()
+            for batch in current_packages._get_root_batches():
+                ancestors = batch._get_complete_ancestors()
+                packages |= ancestors
+                if batch != current_packages:
+                    # only the packages of the batch, invalidating the whole
+                    # cache would drop the values computed for the pickings
+                    Package.invalidate_cache(ids=(batch | ancestors).ids)
 
             picking.entire_package_ids = current_packages | packages
             picking.entire_package_detail_ids = current_packages | packages
 
+    @instrumented
     def _check_entire_pack(self):
         """Set u_result_parent_package_id when moving entire parent package."""
         super(StockPicking, self)._check_entire_pack()
         self._set_u_result_parent_package_id()
 
+    @instrumented
     def _set_u_result_parent_package_id(self):
-        """Set u_result_parent_package_id when moving entire parent package."""
+        """Set u_result_parent_package_id when moving entire parent package.
+
+        Move lines are grouped by result package in a single pass. A parent
+        is entirely moved when each of its child packages is a result
+        package or is entirely moved itself, so nested parents are handled
+        too. Move lines are then written once per parent package.
+
+        Large pickings can be processed in batches of root packages, see
+        stock.move.line _get_root_package_batches.
+        """
         for picking in self:
-            mls = picking.move_line_ids.filtered(lambda ml: not ml.u_result_parent_package_id)
-            # Get result packages of move lines without result parent package
-            result_packages = mls.mapped("result_package_id")
-            parent_packages = result_packages.mapped("package_id")
-            # get all children in bulk
-            parent_packages.mapped("children_ids")
-            for parent_package in parent_packages:
-                if len(parent_package.children_ids - result_packages) == 0:
-                    pack_mls = mls.filtered(
-                        lambda ml: ml.result_package_id.package_id == parent_package
-                        and not ml.u_result_parent_package_id
-                    )
-                    pack_mls.write({"u_result_parent_package_id": parent_package.id})
-                    mls -= pack_mls
+            batches = picking.move_line_ids._get_root_package_batches()
+            for index, move_lines in enumerate(batches):
+                if index:
+                    self.env.invalidate_all()
+                self._set_u_result_parent_package_id_batch(move_lines)
+
+    def _set_u_result_parent_package_id_batch(self, move_lines):
+        """Set u_result_parent_package_id on move_lines, all the move lines
+        of a picking or all those of some root packages."""
+        Package = self.env["stock.quant.package"]
+        MoveLine = self.env["stock.move.line"]
+        result_package_ids = set()
+        ml_ids_by_package = defaultdict(list)
+        # only the lines without result parent package are moved with their
+        # parent package
+        for ml in move_lines:
+            result_package = ml.result_package_id
+            if result_package and not ml.u_result_parent_package_id:
+                result_package_ids.add(result_package.id)
+                ml_ids_by_package[result_package].append(ml.id)
+        result_packages = Package.browse(result_package_ids)
+        complete_ids = set(result_package_ids)
+        complete_ids.update(result_packages._get_complete_ancestors().ids)
+
+        ml_ids_by_parent = defaultdict(list)
+        for result_package, ml_ids in ml_ids_by_package.items():
+            parent_package = result_package.package_id
+            if parent_package.id in complete_ids:
+                ml_ids_by_parent[parent_package.id].extend(ml_ids)
+        for parent_package_id, ml_ids in ml_ids_by_parent.items():
+            MoveLine.browse(ml_ids).write({"u_result_parent_package_id": parent_package_id})
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields, models
+
+
+class StockPickingType(models.Model):
+    _inherit = 'stock.picking.type'
+
+    u_reserve_whole_packages = fields.Boolean(
+        'Reserve Whole Packages', default=False,
+        help="When reserving stock, prefer whole pallets and cases that fit "
+             "the demand over loose quants, instead of breaking packages up.")
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+
+from odoo import api, fields, models
+from odoo.tools.float_utils import float_compare
+
+# Number of quants updated per statement when filling u_root_package_id
+ROOT_PACKAGE_BATCH_SIZE = 50000
+
+
+class StockQuant(models.Model):
+    _inherit = 'stock.quant'
+
+    u_root_package_id = fields.Many2one(
+        'stock.quant.package', 'Root Package', index=True, readonly=True,
+        help="The outermost package containing this quant")
+
+    @api.model
+    def create(self, vals):
+        if vals.get('package_id'):
+            vals = dict(vals, u_root_package_id=self._get_root_package_id(vals['package_id']))
+        quant = super(StockQuant, self).create(vals)
+        quant._rollup_into_packages(1)
+        return quant
+
+    def write(self, vals):
+        if 'package_id' in vals:
+            vals = dict(vals, u_root_package_id=self._get_root_package_id(vals['package_id']))
+            # the packages losing quants have to be recomputed too
+            Package = self.env['stock.quant.package']
+            self.env.add_todo(Package._fields['location_id'], self.mapped('package_id'))
+        rollup = bool({'package_id', 'product_id', 'quantity'} & set(vals))
+        if rollup:
+            old_deltas = self._get_rollup_deltas(-1)
+        res = super(StockQuant, self).write(vals)
+        if rollup:
+            self.env['stock.quant.package']._update_rollups(
+                content_deltas=old_deltas + self._get_rollup_deltas(1))
+        elif 'location_id' in vals and self.filtered('package_id'):
+            # the location of the packages is recomputed
+            self.env['stock.quant.package']._evict_tree_cache(
+                self.mapped('u_root_package_id').ids)
+        return res
+
+    def unlink(self):
+        self._rollup_into_packages(-1)
+        return super(StockQuant, self).unlink()
+
+    @api.model
+    def _update_reserved_quantity(self, product_id, location_id, quantity,
+                                  lot_id=None, package_id=None, owner_id=None,
+                                  strict=False):
+        if self.env.context.get('reserve_whole_packages') and quantity > 0:
+            self = self.with_context(reserve_whole_packages_quantity=quantity)
+        return super(StockQuant, self)._update_reserved_quantity(
+            product_id, location_id, quantity, lot_id=lot_id,
+            package_id=package_id, owner_id=owner_id, strict=strict)
+
+    @api.model
+    def _gather(self, product_id, location_id, lot_id=None, package_id=None,
+                owner_id=None, strict=False):
+        quants = super(StockQuant, self)._gather(
+            product_id, location_id, lot_id=lot_id, package_id=package_id,
+            owner_id=owner_id, strict=strict)
+        quantity = self.env.context.get('reserve_whole_packages_quantity')
+        if quantity and not package_id:
+            quants = quants._sort_whole_packages_first(product_id, quantity)
+        return quants
+
+    def _sort_whole_packages_first(self, product, quantity):
+        """ Return the quants of self with the quants of whole packages
+            fitting quantity first, then the others in their current order.
+
+            A package is whole when it only contains product and all its
+            quants are in self and unreserved, which is checked against the
+            rolled-up contents of the packages. Top-level packages are
+            preferred, then the biggest ones.
+        """
+        Content = self.env['stock.quant.package.content']
+        available_counts = defaultdict(int)
+        for quant in self.filtered('package_id'):
+            if not quant.reserved_quantity:
+                for package_id in quant.package_id._get_ancestor_ids():
+                    available_counts[package_id] += 1
+        if not available_counts:
+            return self
+        contents = Content.search([('package_id', 'in', list(available_counts)),
+                                   ('product_id', '=', product.id)])
+        whole = [
+            content for content in contents
+            if content.quant_count == content.package_id.u_quant_count
+            == available_counts[content.package_id.id]
+        ]
+        whole.sort(key=lambda c: (c.package_id.u_depth, -c.quantity))
+
+        remaining = quantity
+        rounding = product.uom_id.rounding
+        chosen_ids = set()
+        for content in whole:
+            package = content.package_id
+            if chosen_ids.intersection(package._get_ancestor_ids()):
+                continue
+            if float_compare(content.quantity, remaining, precision_rounding=rounding) <= 0:
+                chosen_ids.add(package.id)
+                remaining -= content.quantity
+        if not chosen_ids:
+            return self
+        first = self.filtered(lambda q: chosen_ids.intersection(q.package_id._get_ancestor_ids()))
+        return first | (self - first)
+
+    def _rollup_into_packages(self, sign):
+        """ Add (sign=1) or remove (sign=-1) the quants to or from the
+            rolled-up contents of their package and its ancestors.
+        """
+        self.env['stock.quant.package']._update_rollups(
+            content_deltas=self._get_rollup_deltas(sign))
+
+    def _get_rollup_deltas(self, sign):
+        """ Return the content deltas adding (sign=1) or removing (sign=-1)
+            the quants to or from their package and its ancestors.
+        """
+        return [
+            (quant.package_id._get_ancestor_ids(), quant.product_id.id,
+             sign * quant.quantity, sign)
+            for quant in self if quant.package_id
+        ]
+
+    @api.model
+    def _get_root_package_id(self, package_id):
+        """ Return the id of the outermost package containing package_id. """
+        if not package_id:
+            return False
+        package = self.env['stock.quant.package'].browse(package_id)
+        if not package.parent_path:
+            # the package is being created along with its quants
+            package._parent_path_create()
+        return package._get_ancestor_ids()[0]
+
+    @api.model
+    def _root_package_compute(self, batch_size=ROOT_PACKAGE_BATCH_SIZE):
+        """ Fill u_root_package_id of the quants in packages which do not
+            have one yet, updating at most batch_size quants per statement.
+        """
+        cr = self._cr
+        while True:
+            cr.execute("""
+                UPDATE stock_quant quant
+                SET u_root_package_id = split_part(package.parent_path, '/', 1)::integer
+                FROM stock_quant_package package
+                WHERE quant.id IN (
+                    SELECT q.id FROM stock_quant q
+                    JOIN stock_quant_package p ON p.id = q.package_id
+                    WHERE q.u_root_package_id IS NULL AND p.parent_path IS NOT NULL
+                    LIMIT %s
+                )
+                AND package.id = quant.package_id
+            """, (batch_size,))
+            if not cr.rowcount:
+                break
+        self.invalidate_cache(['u_root_package_id'])
@@ -1,12 +1,102 @@
 """Packages with inheritance."""
 
+import copy
 import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+from weakref import WeakKeyDictionary
 
 from odoo import api, fields, models, _
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
+from odoo.osv import expression
+from odoo.tools.sql import column_exists, create_column, create_index
+
+from .package_hierarchy_stat import instrumented
 
 _logger = logging.getLogger(__name__)
 
+# Number of packages updated per statement when filling parent_path
+PARENT_PATH_BATCH_SIZE = 10000
+
+# Ids of the packages whose trees still have to be validated, per cursor
+# running in deferred checks mode
+_deferred_checks = WeakKeyDictionary()
+
+# System parameter and context key setting the number of records processed
+# at once by the hierarchy post-processing of pickings, 0 to process them
+# all at once
+BATCH_SIZE_PARAM = 'package_hierarchy.batch_size'
+BATCH_SIZE_CONTEXT_KEY = 'package_hierarchy_batch_size'
+
+# Trees returned by get_package_tree, per (database, user, package name),
+# least recently used first, as (expiry time, (database, root package id),
+# tree). Entries are dropped when their root package tree is written in this
+# process and expire after TREE_CACHE_TIMEOUT seconds for the other ones.
+TREE_CACHE_SIZE = 1000
+TREE_CACHE_TIMEOUT = 10
+_tree_cache = OrderedDict()
+# Keys of the cached trees per (database, root package id)
+_tree_cache_roots = defaultdict(set)
+_tree_cache_lock = threading.Lock()
+# Incremented on each eviction, so that trees read before an eviction are
+# not stored
+_tree_cache_generation = [0]
+# Cursors that wrote packages: their trees may be rolled back, so they are
+# neither read from nor stored in the cache
+_tree_cache_dirty = WeakKeyDictionary()
+
+
+def _tree_cache_pop(key):
+    """Drop a cached tree, the caller holding _tree_cache_lock."""
+    root_key = _tree_cache.pop(key)[1]
+    keys = _tree_cache_roots[root_key]
+    keys.discard(key)
+    if not keys:
+        del _tree_cache_roots[root_key]
+
+
+def _minimal_paths(paths):
+    """Drop the paths that are below another path of the list."""
+    res = []
+    for path in sorted(set(paths)):
+        if not res or not path.startswith(res[-1]):
+            res.append(path)
+    return res
+
+
+def split_batches(rows, batch_size):
+    """Split the ids of rows, (key, id) pairs sorted by key, in lists of
+    about batch_size ids, keeping the ids of a same key together."""
+    batches = []
+    batch = []
+    for _key, group in groupby(rows, key=itemgetter(0)):
+        ids = [row[1] for row in group]
+        if batch and len(batch) + len(ids) > batch_size:
+            batches.append(batch)
+            batch = []
+        batch.extend(ids)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _subtree_clause(alias, paths):
+    """Return an SQL condition, and its parameters, matching the rows of
+    alias whose parent_path is in the subtree of one of paths.
+
+    The patterns are passed as constants so that the parent_path index
+    can be used for each of them.
+    """
+    paths = _minimal_paths(paths)
+    if not paths:
+        return 'FALSE', []
+    clause = ' OR '.join(['%s.parent_path LIKE %%s' % alias] * len(paths))
+    return '(%s)' % clause, [path + '%' for path in paths]
+
 
 class QuantPackage(models.Model):
     """ Add the ability for a package to contain another package """
@@ -19,73 +109,1090 @@ class QuantPackage(models.Model):
     display_name = fields.Char('Display Name', compute='_compute_display_name')
     package_id = fields.Many2one(
         'stock.quant.package', 'Parent Package',
-        ondelete='restrict', readonly=True,
+        ondelete='restrict', readonly=True, index=True,
         help="The package containing this item")
-    parent_ids = fields.One2many('stock.quant.package', string='Parent Packages', compute='_compute_parent_ids')
+    parent_path = fields.Char(
+        'Parent Path', readonly=True, copy=False,
+        help="Ids of the package and its ancestors, from the root down, "
+             "e.g. 1/5/9/")
+    parent_ids = fields.One2many('stock.quant.package', string='Parent Packages', compute='_compute_parent_ids',
+                                 search='_search_parent_ids')
+    u_descendant_ids = fields.One2many(
+        'stock.quant.package', string='All Contained Packages',
+        compute='_compute_descendant_ids', search='_search_descendant_ids',
+        help="Packages contained in the package, at any level")
     children_quant_ids = fields.One2many('stock.quant', string='All content', compute='_compute_children_quant_ids')
     children_ids = fields.One2many('stock.quant.package', 'package_id', 'Contained Packages', readonly=True)
+    location_id = fields.Many2one(store=True)
+    company_id = fields.Many2one(store=True)
+    owner_id = fields.Many2one(store=True)
+    u_content_ids = fields.One2many(
+        'stock.quant.package.content', 'package_id', 'Contents Summary',
+        readonly=True,
+        help="Quantity of each product in the package, including the "
+             "packages it contains")
+    u_quant_count = fields.Integer(
+        'Number of Quants', default=0, readonly=True, copy=False,
+        help="Number of quants in the package, including the packages it "
+             "contains")
+    u_descendant_count = fields.Integer(
+        'Number of Contained Packages', default=0, readonly=True, copy=False,
+        help="Number of packages contained in the package, at any level")
+    u_full_name = fields.Char(
+        'Full Name', readonly=True, copy=False,
+        help="Names of the package and its ancestors, from the root down, "
+             "e.g. PALLET/CASE/BOX")
+    u_depth = fields.Integer(
+        'Depth', readonly=True, copy=False,
+        help="Number of packages above the package, 0 for a top-level package")
+
+    def _auto_init(self):
+        # Create the columns of the fields made stored here beforehand, so
+        # that they are filled with a single query rather than computed
+        # record by record by the ORM
+        cr = self._cr
+        new_columns = [name for name in ('location_id', 'company_id', 'owner_id')
+                       if not column_exists(cr, self._table, name)]
+        for name in new_columns:
+            create_column(cr, self._table, name, 'int4')
+        res = super(QuantPackage, self)._auto_init()
+        if new_columns:
+            self._parent_path_compute()
+            self._package_info_compute()
+        return res
+
+    def init(self):
+        # text_pattern_ops lets prefix LIKE queries use the index whatever
+        # the collation of the database
+        create_index(self._cr, 'stock_quant_package_parent_path_index',
+                     self._table, ['parent_path text_pattern_ops'])
+        self._parent_path_compute()
+        self._full_name_compute()
+        # stock.quant is set up before packages, its column exists already
+        self.env['stock.quant']._root_package_compute()
+
+    @api.model
+    def create(self, vals):
+        package = super(QuantPackage, self).create(vals)
+        package._parent_path_create()
+        _tree_cache_dirty[self._cr] = True
+        self._update_rollups(descendant_deltas=[(package._get_ancestor_ids()[:-1], 1)])
+        return package
+
+    def write(self, vals):
+        root_ids = self._get_root_ids()
+        if 'package_id' in vals:
+            packages = self.filtered(lambda p: not isinstance(p.id, models.NewId))
+            old_ancestors = {p: p._get_ancestor_ids()[:-1] for p in packages}
+            # the parents losing children have to be recomputed too
+            self.env.add_todo(self._fields['location_id'], packages.mapped('package_id'))
+            self._parent_path_update(vals['package_id'])
+            # this also evicts the trees of the new roots
+            packages._move_rollups(old_ancestors)
+        self._evict_tree_cache(root_ids, dirty=True)
+        res = super(QuantPackage, self).write(vals)
+        if 'name' in vals:
+            self._full_name_update()
+        return res
+
+    def unlink(self):
+        self._evict_tree_cache(self._get_root_ids(), dirty=True)
+        unlinked_ids = set(self.ids)
+        descendant_deltas = [
+            ([pid for pid in package._get_ancestor_ids() if pid not in unlinked_ids], -1)
+            for package in self
+        ]
+        res = super(QuantPackage, self).unlink()
+        self._update_rollups(descendant_deltas=descendant_deltas)
+        return res
+
+    @api.model
+    def _parent_path_compute(self, batch_size=PARENT_PATH_BATCH_SIZE):
+        """ Fill parent_path of the packages which do not have one yet,
+            e.g. when installing the module on an existing database.
+
+            The tree is filled top-down, a level at a time, updating at
+            most batch_size packages per statement.
+        """
+        cr = self._cr
+        _logger.info('Computing parent_path of stock.quant.package')
+        while True:
+            cr.execute("""
+                UPDATE stock_quant_package
+                SET parent_path = concat(id, '/')
+                WHERE id IN (
+                    SELECT id FROM stock_quant_package
+                    WHERE parent_path IS NULL AND package_id IS NULL
+                    LIMIT %s
+                )
+            """, (batch_size,))
+            if not cr.rowcount:
+                break
+        while True:
+            cr.execute("""
+                UPDATE stock_quant_package node
+                SET parent_path = concat(parent.parent_path, node.id, '/')
+                FROM stock_quant_package parent
+                WHERE node.id IN (
+                    SELECT child.id
+                    FROM stock_quant_package child
+                    JOIN stock_quant_package p ON p.id = child.package_id
+                    WHERE child.parent_path IS NULL
+                    AND p.parent_path IS NOT NULL
+                    LIMIT %s
+                )
+                AND parent.id = node.package_id
+            """, (batch_size,))
+            if not cr.rowcount:
+                break
+        self.invalidate_cache(['parent_path'])
+
+    def _parent_path_create(self):
+        """ Set parent_path of newly created packages. """
+        if not self:
+            return
+        cr = self._cr
+        cr.execute("""
+            UPDATE stock_quant_package node
+            SET parent_path = concat(parent.parent_path, node.id, '/')
+            FROM stock_quant_package parent
+            WHERE node.id IN %s AND parent.id = node.package_id
+        """, (tuple(self.ids),))
+        cr.execute("""
+            UPDATE stock_quant_package
+            SET parent_path = concat(id, '/')
+            WHERE id IN %s AND package_id IS NULL
+        """, (tuple(self.ids),))
+        self._depth_update(self.ids)
+        self.invalidate_cache(['parent_path', 'u_depth'], self.ids)
+        self._full_name_update()
+
+    def _parent_path_update(self, parent_id):
+        """ Move self, and everything below it, under parent_id by
+            rewriting the parent_path prefix of the whole subtrees.
+        """
+        records = self.filtered(lambda p: not isinstance(p.id, models.NewId))
+        if not records:
+            return
+        cr = self._cr
+        prefix = ''
+        if parent_id:
+            parent = self.browse(parent_id)
+            if not parent.parent_path:
+                parent._parent_path_create()
+            prefix = parent.parent_path
+            if set(records.ids) & set(parent._get_ancestor_ids()):
+                raise ValidationError(_("A package cannot be its own parent."))
+        cr.execute("SELECT parent_path FROM stock_quant_package WHERE id IN %s",
+                   (tuple(records.ids),))
+        clause, params = _subtree_clause(
+            'child', [row[0] for row in cr.fetchall() if row[0]])
+        # a package of self below another one of self keeps its own subtree,
+        # so each child is moved along with its closest ancestor in self
+        query = """
+            UPDATE stock_quant_package child
+            SET parent_path = concat(%s, substr(child.parent_path,
+                    length(node.parent_path) - length(node.id || '/') + 1))
+            FROM (
+                SELECT DISTINCT ON (child.id)
+                       child.id AS child_id, node.id, node.parent_path
+                FROM stock_quant_package child
+                JOIN stock_quant_package node
+                    ON child.parent_path LIKE concat(node.parent_path, '%%')
+                WHERE node.id IN %s
+                AND {clause}
+                ORDER BY child.id, length(node.parent_path) DESC
+            ) node
+            WHERE child.id = node.child_id
+            RETURNING child.id
+        """.format(clause=clause)
+        cr.execute(query, [prefix, tuple(records.ids)] + params)
+        child_ids = [row[0] for row in cr.fetchall()]
+        self._depth_update(child_ids)
+        self.invalidate_cache(['parent_path', 'u_depth'], child_ids)
+        records._full_name_update()
+        if child_ids:
+            cr.execute("""
+                UPDATE stock_quant quant
+                SET u_root_package_id = split_part(package.parent_path, '/', 1)::integer
+                FROM stock_quant_package package
+                WHERE package.id IN %s AND quant.package_id = package.id
+                RETURNING quant.id
+            """, (tuple(child_ids),))
+            self.env['stock.quant'].invalidate_cache(
+                ['u_root_package_id'], [row[0] for row in cr.fetchall()])
+
+    def _full_name_update(self):
+        """ Recompute u_full_name of the packages of the subtrees of self. """
+        clause, params = _subtree_clause(
+            'package', [p for p in self.mapped('parent_path') if p])
+        self._cr.execute(self._full_name_query(clause), params)
+        self.invalidate_cache(['u_full_name', 'display_name'],
+                              [row[0] for row in self._cr.fetchall()])
+
+    @api.model
+    def _full_name_compute(self):
+        """ Fill in u_full_name of the packages that have none. """
+        self._cr.execute(self._full_name_query(
+            'package.u_full_name IS NULL AND package.parent_path IS NOT NULL'))
+        if self._cr.rowcount:
+            _logger.info('Computed full name of %d stock.quant.package', self._cr.rowcount)
+            self.invalidate_cache(['u_full_name', 'display_name'])
+
+    @api.model
+    def _full_name_query(self, clause):
+        """ Return a query setting u_full_name of the packages matching
+            clause from the names of the packages of their parent_path.
+        """
+        return """
+            UPDATE stock_quant_package package
+            SET u_full_name = (
+                SELECT string_agg(ancestor.name, '/' ORDER BY path.position)
+                FROM unnest(string_to_array(rtrim(package.parent_path, '/'), '/'))
+                    WITH ORDINALITY AS path(id, position)
+                JOIN stock_quant_package ancestor ON ancestor.id = path.id::integer
+            )
+            WHERE {clause}
+            RETURNING package.id
+        """.format(clause=clause)
+
+    @api.model
+    def _depth_update(self, ids):
+        """ Set u_depth of packages ids from their parent_path. """
+        if ids:
+            self._cr.execute("""
+                UPDATE stock_quant_package
+                SET u_depth = length(parent_path) - length(replace(parent_path, '/', '')) - 1
+                WHERE id IN %s
+            """, (tuple(ids),))
+
+    @api.model
+    def _rollup_compute(self):
+        """ Recompute the rolled-up contents, quant and package counts and
+            depth of all the packages from scratch.
+        """
+        cr = self._cr
+        _logger.info('Computing rolled-up contents of stock.quant.package')
+        cr.execute("DELETE FROM stock_quant_package_content")
+        cr.execute("""
+            INSERT INTO stock_quant_package_content
+                (package_id, product_id, quantity, quant_count)
+            SELECT ancestor.id::integer, quant.product_id,
+                   sum(quant.quantity), count(*)
+            FROM stock_quant quant
+            JOIN stock_quant_package package ON package.id = quant.package_id
+            CROSS JOIN LATERAL unnest(string_to_array(
+                rtrim(package.parent_path, '/'), '/')) AS ancestor(id)
+            GROUP BY ancestor.id, quant.product_id
+        """)
+        cr.execute("""
+            UPDATE stock_quant_package package
+            SET u_quant_count = COALESCE(content.quant_count, 0),
+                u_descendant_count = COALESCE(descendant.package_count, 0),
+                u_depth = length(package.parent_path)
+                    - length(replace(package.parent_path, '/', '')) - 1
+            FROM stock_quant_package p
+            LEFT JOIN (
+                SELECT package_id, sum(quant_count) AS quant_count
+                FROM stock_quant_package_content
+                GROUP BY package_id
+            ) content ON content.package_id = p.id
+            LEFT JOIN (
+                SELECT ancestor.id::integer AS package_id, count(*) AS package_count
+                FROM stock_quant_package child
+                CROSS JOIN LATERAL unnest(string_to_array(
+                    rtrim(child.parent_path, '/'), '/')) AS ancestor(id)
+                WHERE ancestor.id::integer != child.id
+                GROUP BY ancestor.id
+            ) descendant ON descendant.package_id = p.id
+            WHERE package.id = p.id
+        """)
+        self.env['stock.quant.package.content'].invalidate_cache()
+        self.invalidate_cache(['u_content_ids', 'u_quant_count',
+                               'u_descendant_count', 'u_depth'])
+        self._clear_tree_cache()
+
+    @api.model
+    def _update_rollups(self, content_deltas=(), descendant_deltas=()):
+        """ Incrementally update the rolled-up contents and counts of
+            packages, with a fixed number of statements.
+
+            :param content_deltas: iterable of (package ids, product id,
+                quantity, quant count) to add to each of the package ids
+            :param descendant_deltas: iterable of (package ids, count) to
+                add to the number of contained packages of each package id
+        """
+        cr = self._cr
+        contents = defaultdict(lambda: [0.0, 0])
+        quant_counts = defaultdict(int)
+        for package_ids, product_id, quantity, quant_count in content_deltas:
+            for package_id in package_ids:
+                content = contents[package_id, product_id]
+                content[0] += quantity
+                content[1] += quant_count
+                quant_counts[package_id] += quant_count
+        descendant_counts = defaultdict(int)
+        for package_ids, count in descendant_deltas:
+            for package_id in package_ids:
+                descendant_counts[package_id] += count
+
+        values = [(package_id, product_id, quantity, quant_count)
+                  for (package_id, product_id), (quantity, quant_count) in contents.items()
+                  if quantity or quant_count]
+        if values:
+            rows = ', '.join(['(%s, %s, %s, %s)'] * len(values))
+            params = [param for row in values for param in row]
+            cr.execute("""
+                INSERT INTO stock_quant_package_content AS content
+                    (package_id, product_id, quantity, quant_count)
+                VALUES {rows}
+                ON CONFLICT (package_id, product_id) DO UPDATE
+                SET quantity = content.quantity + EXCLUDED.quantity,
+                    quant_count = content.quant_count + EXCLUDED.quant_count
+            """.format(rows=rows), params)
+            # only quants leaving packages can empty a content row
+            removed_ids = set(row[0] for row in values if row[3] < 0)
+            if removed_ids:
+                cr.execute("""
+                    DELETE FROM stock_quant_package_content
+                    WHERE package_id IN %s AND quant_count <= 0
+                """, (tuple(removed_ids),))
+            self.env['stock.quant.package.content'].invalidate_cache()
+            self.invalidate_cache(['u_content_ids'])
+
+        for column, deltas in (('u_quant_count', quant_counts),
+                               ('u_descendant_count', descendant_counts)):
+            values = [(package_id, delta) for package_id, delta in deltas.items() if delta]
+            if values:
+                rows = ', '.join(['(%s, %s)'] * len(values))
+                cr.execute("""
+                    UPDATE stock_quant_package package
+                    SET {column} = package.{column} + delta.value
+                    FROM (VALUES {rows}) AS delta(id, value)
+                    WHERE package.id = delta.id
+                """.format(column=column, rows=rows),
+                    [param for row in values for param in row])
+                self.invalidate_cache([column], [row[0] for row in values])
+        # the deltas are added to all the ancestors, so the roots are among
+        # the updated packages
+        self._evict_tree_cache(set(quant_counts) | set(descendant_counts))
+
+    def _move_rollups(self, old_ancestors):
+        """ Move the rolled-up contents of the packages of self from their
+            previous ancestors to their current ones.
+
+            :param old_ancestors: dictionary {package: ids of the ancestors
+                of the package before it was moved}
+        """
+        contents = {}
+        counts = {}
+        for package in self:
+            contents[package.id] = {
+                content.product_id.id: (content.quantity, content.quant_count)
+                for content in package.u_content_ids
+            }
+            counts[package.id] = package.u_descendant_count + 1
+        # a package moved along with one of its ancestors leaves it, so its
+        # contents are moved on their own rather than as part of the
+        # contents of its closest moved ancestor
+        moved_contents = {pid: defaultdict(lambda: [0.0, 0]) for pid in contents}
+        moved_counts = dict(counts)
+        for package_id, package_contents in contents.items():
+            for product_id, (quantity, quant_count) in package_contents.items():
+                moved_contents[package_id][product_id][0] += quantity
+                moved_contents[package_id][product_id][1] += quant_count
+        for package in self:
+            ancestor_id = next((pid for pid in reversed(old_ancestors[package])
+                                if pid in contents), None)
+            if ancestor_id:
+                for product_id, (quantity, quant_count) in contents[package.id].items():
+                    moved_contents[ancestor_id][product_id][0] -= quantity
+                    moved_contents[ancestor_id][product_id][1] -= quant_count
+                moved_counts[ancestor_id] -= counts[package.id]
+
+        content_deltas = []
+        descendant_deltas = []
+        for package in self:
+            old_ids = old_ancestors[package]
+            new_ids = package._get_ancestor_ids()[:-1]
+            if old_ids == new_ids:
+                continue
+            for product_id, (quantity, quant_count) in moved_contents[package.id].items():
+                content_deltas.append((old_ids, product_id, -quantity, -quant_count))
+                content_deltas.append((new_ids, product_id, quantity, quant_count))
+            count = moved_counts[package.id]
+            descendant_deltas.append((old_ids, -count))
+            descendant_deltas.append((new_ids, count))
+        self._update_rollups(content_deltas, descendant_deltas)
+
+    @api.model
+    @instrumented
+    def get_package_tree(self, name):
+        """ Return the package named name with its ancestors, descendants
+            and rolled-up contents, as a JSON serializable dictionary, or
+            False if there is no such package.
+
+            This is meant for scanners resolving a package barcode, so it
+            reads everything with a fixed number of queries, and the result
+            is kept in a small process-local cache. Transactions that wrote
+            packages bypass the cache, so that it never holds packages that
+            may be rolled back. Unknown names are not cached.
+        """
+        self.check_access_rights('read')
+        if self._cr in _tree_cache_dirty:
+            return self._read_package_tree(name)
+        dbname = self._cr.dbname
+        key = (dbname, self._uid, name)
+        with _tree_cache_lock:
+            entry = _tree_cache.get(key)
+            if entry and entry[0] > time.time():
+                _tree_cache.move_to_end(key)
+                return copy.deepcopy(entry[2])
+            generation = _tree_cache_generation[0]
+        tree = self._read_package_tree(name)
+        if not tree:
+            return tree
+        with _tree_cache_lock:
+            if generation == _tree_cache_generation[0]:
+                if key in _tree_cache:
+                    _tree_cache_pop(key)
+                root_key = (dbname, tree['root']['id'])
+                _tree_cache[key] = (time.time() + TREE_CACHE_TIMEOUT, root_key, tree)
+                _tree_cache_roots[root_key].add(key)
+                while len(_tree_cache) > TREE_CACHE_SIZE:
+                    _tree_cache_pop(next(iter(_tree_cache)))
+        return copy.deepcopy(tree)
+
+    @api.model
+    def _read_package_tree(self, name):
+        """ Read the tree returned by get_package_tree, bypassing the cache. """
+        cr = self._cr
+        cr.execute("""
+            SELECT id, parent_path FROM stock_quant_package
+            WHERE name = %s ORDER BY id LIMIT 1
+        """, (name,))
+        row = cr.fetchone()
+        if not row:
+            return False
+        package_id, parent_path = row
+        self.browse(package_id).check_access_rule('read')
+        ancestor_ids = [int(pid) for pid in parent_path.split('/') if pid]
+
+        cr.execute("""
+            SELECT package.id, package.name, package.package_id, package.u_depth,
+                   package.u_quant_count, package.u_descendant_count,
+                   location.id, location.complete_name
+            FROM stock_quant_package package
+            LEFT JOIN stock_location location ON location.id = package.location_id
+            WHERE package.id IN %s OR package.parent_path LIKE %s
+            ORDER BY package.parent_path
+        """, (tuple(ancestor_ids), parent_path + '%'))
+        nodes = OrderedDict()
+        for (node_id, node_name, parent_id, depth, quant_count,
+             descendant_count, location_id, location_name) in cr.fetchall():
+            nodes[node_id] = {
+                'id': node_id,
+                'name': node_name,
+                'parent_id': parent_id or False,
+                'depth': depth,
+                'location_id': location_id and [location_id, location_name] or False,
+                'quant_count': quant_count,
+                'descendant_count': descendant_count,
+            }
+
+        cr.execute("""
+            SELECT product_id, quantity, quant_count
+            FROM stock_quant_package_content
+            WHERE package_id = %s
+            ORDER BY product_id
+        """, (package_id,))
+        rows = cr.fetchall()
+        products = self.env['product.product'].browse([row[0] for row in rows])
+        product_names = dict(products.name_get())
+        contents = [{
+            'product_id': [product_id, product_names.get(product_id)],
+            'quantity': quantity,
+            'quant_count': quant_count,
+        } for product_id, quantity, quant_count in rows]
+
+        tree = dict(nodes[package_id])
+        tree.update({
+            'root': nodes[ancestor_ids[0]],
+            'ancestors': [nodes[pid] for pid in ancestor_ids[:-1]],
+            'descendants': [node for node_id, node in nodes.items()
+                            if node_id not in ancestor_ids],
+            'contents': contents,
+        })
+        return tree
+
+    def get_children_page(self, offset=0, limit=80):
+        """ Return one page of the packages and quants directly contained in
+            the package, packages first, with their rolled-up counts, as a
+            JSON serializable dictionary.
+
+            Only the requested page is read, so that large packages can be
+            expanded level by level whatever their size.
+        """
+        self.ensure_one()
+        Quant = self.env['stock.quant']
+        child_domain = [('package_id', '=', self.id)]
+        child_count = self.search_count(child_domain)
+        quant_count = Quant.search_count(child_domain)
+        children = self.browse()
+        if offset < child_count:
+            children = self.search(child_domain, offset=offset, limit=limit, order='name, id')
+        quants = Quant.browse()
+        if limit is None or len(children) < limit:
+            quants = Quant.search(
+                child_domain, offset=max(offset - child_count, 0),
+                limit=limit and limit - len(children), order='id')
+        return {
+            'id': self.id,
+            'name': self.name,
+            'quant_count': self.u_quant_count,
+            'descendant_count': self.u_descendant_count,
+            'child_count': child_count,
+            'direct_quant_count': quant_count,
+            'offset': offset,
+            'limit': limit,
+            'children': children.read(['name', 'location_id', 'u_quant_count',
+                                       'u_descendant_count']),
+            'quants': quants.read(['product_id', 'lot_id', 'quantity',
+                                   'product_uom_id']),
+        }
+
+    def action_view_children(self):
+        """ Browse the content of the package one level and one page at a
+            time.
+        """
+        self.ensure_one()
+        return self.env['package.hierarchy.browser'].open_package(self.id)
+
+    def action_view_all_quants(self):
+        """ Open the quants of the package and of the packages it contains. """
+        self.ensure_one()
+        return {
+            'type': 'ir.actions.act_window',
+            'name': _('Package Contents'),
+            'res_model': 'stock.quant',
+            'view_mode': 'tree,form',
+            'domain': self._get_descendant_domain('package_id.parent_path'),
+        }
+
+    @api.model
+    def _clear_tree_cache(self):
+        """ Drop the trees cached by get_package_tree, and stop caching the
+            trees read by the current transaction.
+        """
+        _tree_cache_dirty[self._cr] = True
+        with _tree_cache_lock:
+            _tree_cache.clear()
+            _tree_cache_roots.clear()
+            _tree_cache_generation[0] += 1
+
+    @api.model
+    def _evict_tree_cache(self, root_ids, dirty=False):
+        """ Drop the trees cached by get_package_tree under the given root
+            packages. With dirty, also stop caching the trees read by the
+            current transaction, which wrote packages.
+        """
+        if dirty:
+            _tree_cache_dirty[self._cr] = True
+        dbname = self._cr.dbname
+        with _tree_cache_lock:
+            for root_id in root_ids:
+                for key in list(_tree_cache_roots.get((dbname, root_id), ())):
+                    _tree_cache_pop(key)
+            _tree_cache_generation[0] += 1
+
+    def _get_root_ids(self):
+        """ Return the set of the ids of the root packages of self. """
+        return set(int(path.split('/', 1)[0])
+                   for path in self.mapped('parent_path') if path)
+
+    def _get_ancestor_ids(self):
+        """ Return the ids of the package and its ancestors, root first. """
+        self.ensure_one()
+        return [int(pid) for pid in (self.parent_path or '').split('/') if pid]
+
+    def _get_descendant_domain(self, path_field='parent_path'):
+        """ Return a domain matching the packages of the subtrees of self.
+            path_field allows to match records linked to those packages,
+            e.g. package_id.parent_path for quants.
+        """
+        paths = _minimal_paths([p for p in self.mapped('parent_path') if p])
+        domain = [(path_field, '=like', path + '%') for path in paths]
+        if not domain:
+            return [('id', '=', False)]
+        return ['|'] * (len(domain) - 1) + domain
+
+    def move_package_tree(self, location_dest_id):
+        """ Move the whole content of the top-level packages of self to
+            location_dest_id, with set-based updates.
+
+            A done stock.move is created per product and source location and
+            a done move line per quant, so that the history is kept, but the
+            move lines and quants are written with one statement each rather
+            than through _action_done. This is only allowed for unreserved
+            stock moved between internal locations of the same company, which
+            has no stock valuation.
+
+            As the move lines, quants and packages are written in SQL, access
+            to them is checked explicitly beforehand.
+
+            Return the done moves.
+        """
+        Location = self.env['stock.location']
+        Move = self.env['stock.move']
+        MoveLine = self.env['stock.move.line']
+        Quant = self.env['stock.quant']
+        location_dest = Location.browse(location_dest_id)
+
+        if self.filtered('package_id'):
+            raise UserError(_('Only top-level packages can be moved as a whole:\n%s')
+                            % ', '.join(self.filtered('package_id').mapped('name')))
+        quants = Quant.search([('u_root_package_id', 'in', self.ids)])
+        if quants.filtered('reserved_quantity'):
+            raise UserError(_('Packages with reserved stock cannot be moved as a whole:\n%s')
+                            % ', '.join(quants.filtered('reserved_quantity').mapped('u_root_package_id.name')))
+        locations = quants.mapped('location_id') | location_dest
+        if locations.filtered(lambda l: l.usage != 'internal') or len(locations.mapped('company_id')) > 1:
+            raise UserError(_('Packages can only be moved as a whole between internal '
+                              'locations of the same company.'))
+        self._check_not_multi_location()
+        self.check_access_rights('write')
+        self.check_access_rule('write')
+        if not quants:
+            return Move.browse()
+        quants.check_access_rights('write')
+        quants.check_access_rule('write')
+        MoveLine.check_access_rights('create')
+
+        quantity_by_move_key = defaultdict(float)
+        for quant in quants:
+            quantity_by_move_key[quant.product_id, quant.location_id] += quant.quantity
+        now = fields.Datetime.now()
+        moves = Move.browse()
+        move_values = []
+        for (product, location), quantity in quantity_by_move_key.items():
+            move = Move.create({
+                'name': _('Package move'),
+                'product_id': product.id,
+                'product_uom': product.uom_id.id,
+                'product_uom_qty': quantity,
+                'location_id': location.id,
+                'location_dest_id': location_dest.id,
+                'date': now,
+                'state': 'done',
+            })
+            moves |= move
+            move_values.extend([move.id, product.id, location.id])
+
+        cr = self._cr
+        rows = ', '.join(['(%s, %s, %s)'] * len(moves))
+        cr.execute("""
+            INSERT INTO stock_move_line
+                (create_uid, create_date, write_uid, write_date, move_id,
+                 product_id, product_uom_id, product_qty, product_uom_qty,
+                 ordered_qty, qty_done, lot_id, package_id, result_package_id,
+                 owner_id, location_id, location_dest_id, date, state, reference)
+            SELECT %s, %s, %s, %s, move.id,
+                   quant.product_id, move.product_uom, 0, 0,
+                   quant.quantity, quant.quantity, quant.lot_id, quant.package_id,
+                   quant.package_id, quant.owner_id, quant.location_id, %s, %s,
+                   move.state, move.reference
+            FROM stock_quant quant
+            JOIN (VALUES {rows}) AS move_key(move_id, product_id, location_id)
+                ON move_key.product_id = quant.product_id
+                AND move_key.location_id = quant.location_id
+            JOIN stock_move move ON move.id = move_key.move_id
+            WHERE quant.id IN %s
+        """.format(rows=rows), [self._uid, now, self._uid, now, location_dest.id, now]
+            + move_values + [tuple(quants.ids)])
+        cr.execute("UPDATE stock_quant SET location_id = %s WHERE id IN %s",
+                   (location_dest.id, tuple(quants.ids)))
+        clause, params = _subtree_clause('package', self.mapped('parent_path'))
+        cr.execute("""
+            UPDATE stock_quant_package package SET location_id = %s
+            WHERE package.u_quant_count > 0 AND {clause}
+        """.format(clause=clause), [location_dest.id] + params)
+        self.env.invalidate_all()
+        self._evict_tree_cache(self.ids, dirty=True)
+        return moves
+
+    @api.model
+    def nest_packages(self, parent_by_child):
+        """ Set the parent package of many packages at once.
+
+            :param parent_by_child: dictionary {child package id: parent
+                package id, or False to take the child out of its parent}
+
+            Cycles and multiple locations are checked for the whole batch,
+            and all the violations are reported in a single ValidationError,
+            in which case no package is changed. Packages are written once
+            per distinct parent, and each tree is validated once.
+        """
+        parent_by_child = {int(child_id): parent_id or False
+                           for child_id, parent_id in parent_by_child.items()}
+        packages = self.browse(list(parent_by_child) + [
+            pid for pid in parent_by_child.values() if pid])
+
+        # current parent of every package above the ones involved
+        current_parent = {}
+        for package in packages:
+            ancestor_ids = package._get_ancestor_ids()
+            current_parent.update(zip(ancestor_ids[1:], ancestor_ids))
+            current_parent.setdefault(ancestor_ids[0], False)
+
+        def new_parent(package_id):
+            if package_id in parent_by_child:
+                return parent_by_child[package_id]
+            return current_parent.get(package_id, False)
+
+        errors = []
+        child_ids_by_parent = defaultdict(list)
+        for child in self.browse(list(parent_by_child)):
+            parent_id = parent_by_child[child.id]
+            if parent_id == current_parent.get(child.id, False):
+                continue
+            ancestor_id, seen = parent_id, set()
+            while ancestor_id and ancestor_id != child.id and ancestor_id not in seen:
+                seen.add(ancestor_id)
+                ancestor_id = new_parent(ancestor_id)
+            if ancestor_id == child.id:
+                errors.append(_("A package cannot be its own parent.") + '\n%s' % child.name)
+            else:
+                child_ids_by_parent[parent_id].append(child.id)
+
+        def new_depth(package_id):
+            depth, seen = 0, set()
+            while package_id and package_id not in seen:
+                seen.add(package_id)
+                package_id = new_parent(package_id)
+                depth += 1
+            return depth
+
+        # Writing the parents from the top of the new tree down only links
+        # packages to parents whose ancestors are already final, so that no
+        # intermediate state has a cycle
+        writes = sorted(child_ids_by_parent.items(), key=lambda item: new_depth(item[0]))
+        try:
+            with self._cr.savepoint():
+                try:
+                    with self._deferred_hierarchy_checks():
+                        for parent_id, child_ids in writes:
+                            self.browse(child_ids).write({'package_id': parent_id})
+                except ValidationError as e:
+                    errors.append(e.name)
+                if errors:
+                    raise ValidationError('\n'.join(errors))
+        except ValidationError:
+            # the cache may hold values rolled back with the savepoint
+            self.env.invalidate_all()
+            raise
+        return True
+
+    @api.model
+    def _get_hierarchy_batch_size(self):
+        """ Return the number of records processed at once by the
+            hierarchy post-processing of pickings, 0 if they are all
+            processed at once.
+        """
+        batch_size = self.env.context.get(BATCH_SIZE_CONTEXT_KEY)
+        if batch_size is None:
+            batch_size = self.env['ir.config_parameter'].sudo().get_param(BATCH_SIZE_PARAM, 0)
+        return int(batch_size)
+
+    def _get_root_batches(self):
+        """ Split self in batches of packages, keeping the packages of a
+            same root package together.
+        """
+        batch_size = self._get_hierarchy_batch_size()
+        if not batch_size or len(self) <= batch_size:
+            return [self]
+        self._cr.execute("""
+            SELECT split_part(parent_path, '/', 1), id
+            FROM stock_quant_package
+            WHERE id IN %s
+            ORDER BY 1, 2
+        """, (tuple(self.ids),))
+        return [self.browse(ids) for ids in split_batches(self._cr.fetchall(), batch_size)]
+
+    @instrumented
+    def _get_complete_ancestors(self):
+        """ Return the ancestors of the packages of self all of whose child
+            packages are either in self or complete ancestors themselves,
+            rolling complete packages up to the highest complete ancestor.
+
+            The hierarchy is processed bottom-up with a fixed number of
+            queries, whatever its depth.
+        """
+        complete_ids = set(self.ids)
+        depth_by_ancestor = {}
+        for package in self:
+            ancestor_ids = package._get_ancestor_ids()
+            for depth, ancestor_id in enumerate(ancestor_ids[:-1]):
+                depth_by_ancestor[ancestor_id] = depth
+        candidate_ids = set(depth_by_ancestor) - complete_ids
+        if not candidate_ids:
+            return self.browse()
+        children_by_parent = defaultdict(set)
+        for child in self.search([('package_id', 'in', list(candidate_ids))]):
+            children_by_parent[child.package_id.id].add(child.id)
+        res = []
+        for ancestor_id in sorted(candidate_ids, key=depth_by_ancestor.get, reverse=True):
+            if children_by_parent[ancestor_id] <= complete_ids:
+                complete_ids.add(ancestor_id)
+                res.append(ancestor_id)
+        return self.browse(res)
 
     @api.constrains('package_id')
     def _check_parent_not_multi_location(self):
-        for parent_package in self.mapped('package_id'):
-            parent_package._check_not_multi_location()
+        parents = self.mapped('package_id')
+        if not parents._add_deferred_checks():
+            parents._check_not_multi_location()
 
     @api.constrains("package_id")
     def _check_package_recursion(self):
-        if not self._check_recursion("package_id"):
-            raise ValidationError("A package cannot be its own parent.")
+        # Cycles are rejected when parent_path is updated, so a package
+        # in its parent's path means the hierarchy got corrupted
+        for package in self.filtered('package_id'):
+            if package.id in package.package_id._get_ancestor_ids():
+                raise ValidationError("A package cannot be its own parent.")
+
+    @contextmanager
+    def _deferred_hierarchy_checks(self):
+        """ Postpone the multi-location validation of the package trees
+            written within the block to the end of the block, where each
+            tree is validated once.
+
+            The checks are deferred for everything done with the current
+            cursor. Nested blocks are validated by the outermost one, and
+            nothing is validated if the block raises.
+        """
+        cr = self._cr
+        if cr in _deferred_checks:
+            yield
+            return
+        _deferred_checks[cr] = package_ids = set()
+        try:
+            yield
+        finally:
+            del _deferred_checks[cr]
+        self.browse(package_ids).exists()._check_not_multi_location()
+
+    def _add_deferred_checks(self):
+        """ Record self for validation at the end of the current deferred
+            checks block, if any. Return whether the checks are deferred.
+        """
+        package_ids = _deferred_checks.get(self._cr)
+        if package_ids is None:
+            return False
+        package_ids.update(self.ids)
+        return True
 
+    @instrumented
     def _check_not_multi_location(self):
-        for package in self:
-            locations = package.children_quant_ids.mapped('location_id')
-            if len(locations) > 1:
-                raise ValidationError(_('Package cannot be in multiple '
-                                        'locations:\n%s\n%s') % (package.name,
-                                                                 ', '.join( [l.name for l in locations])))
+        """ Check that the contents of every package in the trees of self
+            are in a single location, reporting all the offending packages
+            at once.
+        """
+        multi_location = self._get_multi_location_packages()
+        if multi_location:
+            Location = self.env['stock.location']
+            packages = self.browse(sorted(multi_location))
+            raise ValidationError('\n'.join(
+                _('Package cannot be in multiple locations:\n%s\n%s') % (
+                    package.name,
+                    ', '.join(Location.browse(multi_location[package.id]).mapped('name')))
+                for package in packages))
+
+    def _get_multi_location_packages(self):
+        """ Return a dictionary {package id: location ids} of the packages,
+            in the trees of the packages of self, whose quants are in more
+            than one location.
+
+            All the trees are checked with a single aggregate query.
+        """
+        packages = self.filtered(lambda p: not isinstance(p.id, models.NewId))
+        root_paths = ['%d/' % package._get_ancestor_ids()[0]
+                      for package in packages if package.parent_path]
+        if not root_paths:
+            return {}
+        clause, params = _subtree_clause('package', root_paths)
+        self._cr.execute("""
+            SELECT ancestor.id::integer, array_agg(DISTINCT quant.location_id)
+            FROM stock_quant quant
+            JOIN stock_quant_package package ON package.id = quant.package_id
+            CROSS JOIN LATERAL unnest(string_to_array(
+                rtrim(package.parent_path, '/'), '/')) AS ancestor(id)
+            WHERE {clause}
+            GROUP BY ancestor.id
+            HAVING count(DISTINCT quant.location_id) > 1
+        """.format(clause=clause), params)
+        return dict(self._cr.fetchall())
 
     @api.depends('package_id', 'children_ids')
+    @instrumented
     def _compute_parent_ids(self):
+        """ Ancestors are read from parent_path, which is prefetched for the
+            whole recordset.
+        """
         for package in self.filtered(lambda p: not isinstance(p.id, models.NewId)):
-            package._check_not_multi_location()
-            package.parent_ids = self.env['stock.quant.package'].search([('id', 'parent_of', package.id)]).ids
+            package.parent_ids = package._get_ancestor_ids()
+
+    def _search_parent_ids(self, operator, value):
+        """ Match the subtrees of the packages matching value, read from
+            parent_path rather than with a recursive child_of.
+        """
+        packages = self._get_hierarchy_search_packages(operator, value)
+        return packages._get_descendant_domain()
+
+    @api.depends('children_ids')
+    @instrumented
+    def _compute_descendant_ids(self):
+        """ Search the descendants of all the packages at once, then hand
+            each of them to every package of self above it.
+        """
+        packages = self.filtered(lambda p: not isinstance(p.id, models.NewId))
+        descendants = self.search(packages._get_descendant_domain())
+        descendant_ids_by_package = defaultdict(list)
+        for descendant in descendants:
+            for package_id in descendant._get_ancestor_ids()[:-1]:
+                descendant_ids_by_package[package_id].append(descendant.id)
+        for package in packages:
+            package.u_descendant_ids = descendant_ids_by_package[package.id]
+
+    def _search_descendant_ids(self, operator, value):
+        """ Match the ancestors of the packages matching value, read from
+            their parent_path.
+        """
+        packages = self._get_hierarchy_search_packages(operator, value)
+        ancestor_ids = set()
+        for package in packages:
+            ancestor_ids.update(package._get_ancestor_ids()[:-1])
+        return [('id', 'in', list(ancestor_ids))]
+
+    @api.model
+    def _get_hierarchy_search_packages(self, operator, value):
+        """ Return the packages matching the operand of a search on
+            parent_ids or u_descendant_ids: ids, or a package name.
+        """
+        if operator in expression.NEGATIVE_TERM_OPERATORS:
+            raise UserError(_("Operator %s is not supported to search the package hierarchy.") % operator)
+        if isinstance(value, str):
+            return self.search([('name', operator, value)])
+        if not isinstance(value, (list, tuple)):
+            value = [value]
+        return self.browse([package_id for package_id in value if package_id])
 
     @api.depends('package_id', 'children_ids', 'quant_ids.package_id')
+    @instrumented
     def _compute_children_quant_ids(self):
-        for package in self.filtered(lambda p: not isinstance(p.id, models.NewId)):
-            package._check_not_multi_location()
-            package.children_quant_ids = self.env['stock.quant'].search([('package_id', 'child_of', package.id)])
+        """ Search the quants of all the subtrees at once, then hand each
+            quant to every package of self above it.
+        """
+        packages = self.filtered(lambda p: not isinstance(p.id, models.NewId))
+        quants = self.env['stock.quant'].search(
+            packages._get_descendant_domain('package_id.parent_path'))
+        quant_ids_by_package = defaultdict(list)
+        for quant in quants:
+            for package_id in quant.package_id._get_ancestor_ids():
+                quant_ids_by_package[package_id].append(quant.id)
+        for package in packages:
+            package.children_quant_ids = quant_ids_by_package[package.id]
 
-    @api.depends('quant_ids.package_id', 'quant_ids.location_id', 'quant_ids.company_id', 'quant_ids.owner_id')
+    @api.depends('quant_ids.package_id', 'quant_ids.location_id', 'quant_ids.company_id', 'quant_ids.owner_id',
+                 'children_ids.location_id', 'children_ids.company_id', 'children_ids.owner_id')
+    @instrumented
     def _compute_package_info(self):
+        """ Take the info from the direct quants of the package, or else from
+            a child package, so that a change of a quant is propagated up the
+            ancestors one level at a time instead of rescanning subtrees.
+        """
         for package in self:
-            values = {'location_id': False, 'company_id': self.env.user.company_id.id, 'owner_id': False}
-            package._check_not_multi_location()
-            values['location_id'] = package.children_quant_ids.mapped('location_id')
-            package.location_id = values['location_id']
-            package.company_id = values['company_id']
-            package.owner_id = values['owner_id']
-
-    @api.depends('package_id')
+            source = package.quant_ids[:1] or package.children_ids.filtered('location_id')[:1]
+            package.location_id = source.location_id
+            package.company_id = source.company_id
+            package.owner_id = source.owner_id
+
+    @api.model
+    def _package_info_compute(self):
+        """ Fill the stored location, company and owner of all the packages
+            from the first quant of their subtree.
+        """
+        _logger.info('Computing location of stock.quant.package')
+        self._cr.execute("""
+            UPDATE stock_quant_package package
+            SET location_id = info.location_id,
+                company_id = info.company_id,
+                owner_id = info.owner_id
+            FROM (
+                SELECT DISTINCT ON (ancestor.id)
+                       ancestor.id::integer AS package_id, quant.location_id,
+                       quant.company_id, quant.owner_id
+                FROM stock_quant quant
+                JOIN stock_quant_package p ON p.id = quant.package_id
+                CROSS JOIN LATERAL unnest(string_to_array(
+                    rtrim(p.parent_path, '/'), '/')) AS ancestor(id)
+                ORDER BY ancestor.id, quant.id
+            ) info
+            WHERE package.id = info.package_id
+        """)
+        self.invalidate_cache(['location_id', 'company_id', 'owner_id'])
+
+    @api.depends('name', 'u_full_name')
     def _compute_display_name(self):
-        """Compute the display name for a package. Include name of immediate parent."""
+        """Compute the display name for a package. Include the names of all its parents."""
         for package in self:
-            package.display_name = '%s/%s' % (package.package_id.name, package.name) if package.package_id else package.name
+            package.display_name = package.u_full_name or package.name
+
+    def name_get(self):
+        return [(package.id, package.u_full_name or package.name) for package in self]
+
+    @api.model
+    def _name_search(self, name='', args=None, operator='ilike', limit=100, name_get_uid=None):
+        """ Match the full name of the packages as well as their name. """
+        args = list(args or [])
+        if name:
+            if operator in expression.NEGATIVE_TERM_OPERATORS:
+                args += ['&', ('name', operator, name), ('u_full_name', operator, name)]
+            else:
+                args += ['|', ('name', operator, name), ('u_full_name', operator, name)]
+        packages = self.browse(self._search(args, limit=limit, access_rights_uid=name_get_uid))
+        return packages.sudo(name_get_uid or self._uid).name_get()
 
     def is_all_contents_in(self, rs):
         """See if the entire contents of a package is in recordset rs.
         rs can be a recordset of quants or packages.
         """
+        return self.filter_all_contents_in(rs) == self
+
+    def filter_all_contents_in(self, rs):
+        """Return the packages of self whose entire contents are in
+        recordset rs. rs can be a recordset of quants or packages.
+
+        Contents are compared as sets of ids, and are read for all the
+        packages at once.
+        """
         if rs._name == 'stock.quant':
-            compare_rs = self.children_quant_ids
+            contents_field = 'children_quant_ids'
         elif rs._name == 'stock.quant.package':
-            compare_rs = self.children_ids
+            contents_field = 'children_ids'
         else:
             msg = "Expected stock.quant or stock.quant.package, got %s instead."
             raise ValidationError(_(msg) % rs._name)
-        return all([a in rs for a in compare_rs])
+        rs_ids = set(rs.ids)
+        return self.filtered(lambda p: rs_ids.issuperset(p[contents_field].ids))
 
+    @instrumented
     def _compute_current_picking_info(self):
-        """When a whole parent is in a picking, add it."""
+        """When a whole parent is in a picking, add it.
+
+        Each parent is filled in once, whatever the number of its children
+        in self, deepest parents first so that a parent of parents gets
+        the values of its children.
+        """
         super(QuantPackage, self)._compute_current_picking_info()
         Picking = self.env['stock.picking']
 
@@ -94,35 +1201,48 @@ class QuantPackage(models.Model):
         if picking:
             picking_packages = picking.entire_package_detail_ids | picking.entire_package_ids
 
-            # TODO: Not sure what this is doing but it fails without it...
+            # Compute the picking info of all the packages of the picking in
+            # one batch, before any parent is filled in below, so that reading
+            # the values of the children does not recompute their parents.
             picking_packages.mapped('current_picking_move_line_ids')
 
-            for package in self:
-                parent_pack = package.package_id
-                if parent_pack and parent_pack.is_all_contents_in(picking_packages):
-                    # entire parent pack is in picking. Add parent package to pickings packages.
-                    children_packs = parent_pack.children_ids
+            candidates = (self | self.mapped('package_id')).filtered('children_ids')
+            complete_parents = candidates.filter_all_contents_in(picking_packages)
+
+            for parent_pack in complete_parents.sorted(
+                    lambda p: len(p._get_ancestor_ids()), reverse=True):
+                # entire parent pack is in picking. Add parent package to pickings packages.
+                children_packs = parent_pack.children_ids
+                move_lines = children_packs.mapped('current_picking_move_line_ids')
 
-                    parent_pack.current_picking_move_line_ids = children_packs.mapped('current_picking_move_line_ids')
-                    parent_pack.current_picking_id = True
-                    parent_pack.current_source_location_id = children_packs[:1].current_picking_move_line_ids[:1].location_id
-                    parent_pack.current_destination_location_id = children_packs[:1].current_picking_move_line_ids[:1].location_dest_id
-                    parent_pack.is_processed = all([p.is_processed for p in children_packs])
+                parent_pack.current_picking_move_line_ids = move_lines
+                parent_pack.current_picking_id = True
+                parent_pack.current_source_location_id = move_lines[:1].location_id
+                parent_pack.current_destination_location_id = move_lines[:1].location_dest_id
+                parent_pack.is_processed = all(children_packs.mapped('is_processed'))
 
+    @instrumented
     def action_toggle_processed(self):
+        """ Set the quantity done of the move lines of the packages to their
+            reserved quantity, or to 0 when they are all processed already.
+
+            Parent packages hold the move lines of their whole content, and
+            move lines are written once per distinct value to write.
+        """
         picking_id = self.env.context.get('picking_id')
         if picking_id:
-            self.ensure_one()
-
-            move_lines = self.current_picking_move_line_ids
+            MoveLine = self.env['stock.move.line']
+            move_lines = self.mapped('current_picking_move_line_ids')
 
             if move_lines.filtered(lambda ml: ml.qty_done < ml.product_uom_qty):
                 destination_location = self.env.context.get('destination_location')
+                ml_ids_by_qty = defaultdict(list)
                 for ml in move_lines:
-                    vals = {'qty_done': ml.product_uom_qty}
+                    ml_ids_by_qty[ml.product_uom_qty].append(ml.id)
+                for qty, ml_ids in ml_ids_by_qty.items():
+                    vals = {'qty_done': qty}
                     if destination_location:
                         vals['location_dest_id'] = destination_location
-                    ml.write(vals)
+                    MoveLine.browse(ml_ids).write(vals)
             else:
-                for ml in move_lines:
-                    ml.qty_done = 0
+                move_lines.write({'qty_done': 0})
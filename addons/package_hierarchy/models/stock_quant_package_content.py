@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields, models
+from odoo.addons import decimal_precision as dp
+
+
+class QuantPackageContent(models.Model):
+    """ Quantity of a product in a package, including the packages it
+        contains. Maintained incrementally by stock.quant.package.
+    """
+    _name = 'stock.quant.package.content'
+    _description = 'Package Contents Summary'
+    _rec_name = 'product_id'
+    _order = 'package_id, product_id'
+
+    package_id = fields.Many2one(
+        'stock.quant.package', 'Package', required=True, index=True,
+        ondelete='cascade', readonly=True)
+    product_id = fields.Many2one(
+        'product.product', 'Product', required=True, index=True,
+        ondelete='cascade', readonly=True)
+    quantity = fields.Float(
+        'Quantity', digits=dp.get_precision('Product Unit of Measure'),
+        readonly=True)
+    quant_count = fields.Integer('Number of Quants', readonly=True)
+
+    _sql_constraints = [
+        ('package_product_uniq', 'unique (package_id, product_id)',
+         'Package contents must be unique per product.'),
+    ]
+
+    def init(self):
+        # Packages get their depth when created, so packages without one
+        # predate the rolled-up data
+        self._cr.execute("SELECT 1 FROM stock_quant_package WHERE u_depth IS NULL LIMIT 1")
+        if self._cr.fetchone():
+            self.env['stock.quant.package']._rollup_compute()
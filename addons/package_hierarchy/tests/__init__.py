@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 """Package hierarchy tests"""
 
+from . import test_benchmark
 from . import test_package_hierarchy
-
+from . import test_query_budget
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from contextlib import contextmanager
+
 from odoo.tests import common
 
 
@@ -101,3 +103,54 @@ class BaseHierarchy(common.SavepointCase):
         }
         vals.update(kwargs)
         return Quant.create(vals)
+
+    @classmethod
+    def create_hierarchy(cls, depth, fan_out, quants_per_package, location, product,
+                         roots=1):
+        """ Create a tree of packages and return it as a list of recordsets,
+            one per level from the top-level packages down. Each package
+            contains fan_out packages, and the packages of the lowest level
+            contain quants_per_package quants of product at location.
+        """
+        Package = cls.env['stock.quant.package']
+        levels = [Package.browse([Package.create({}).id for _ in range(roots)])]
+        for _ in range(depth - 1):
+            levels.append(Package.browse([
+                Package.create({'package_id': parent.id}).id
+                for parent in levels[-1] for _ in range(fan_out)
+            ]))
+        for package in levels[-1]:
+            for _ in range(quants_per_package):
+                cls.create_quant(product.id, location.id, 1, package_id=package.id)
+        return levels
+
+    @contextmanager
+    def assertQueryBudget(self, method, budget):
+        """ Check that the block runs at most budget queries, reporting
+            method otherwise. The number of queries is stored in the 'count'
+            key of the dictionary yielded.
+        """
+        cr = self.env.cr
+        result = {}
+        start = cr.sql_log_count
+        yield result
+        result['count'] = count = cr.sql_log_count - start
+        self.assertLessEqual(
+            count, budget,
+            "%s ran %d queries, over its budget of %d" % (method, count, budget))
+
+
+class BasePackageTree(BaseHierarchy):
+
+    def setUp(self):
+        """Set up a pallet containing a case containing a box."""
+        super(BasePackageTree, self).setUp()
+
+        Package = self.env["stock.quant.package"]
+
+        self.pallet = Package.create({})
+        self.case = Package.create({"package_id": self.pallet.id})
+        self.box = Package.create({"package_id": self.case.id})
+
+    def path(self, *packages):
+        return "".join("%d/" % p.id for p in packages)
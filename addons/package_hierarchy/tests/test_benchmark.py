@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Performance benchmarks of the package hierarchy.
+
+They are skipped unless PACKAGE_HIERARCHY_BENCHMARK is set. Scenarios can be
+given as PACKAGE_HIERARCHY_BENCHMARK=depth:fan_out:quants,... e.g. 3:10:2,
+and the results are logged as JSON, and appended as JSON lines to the file
+named by PACKAGE_HIERARCHY_BENCHMARK_OUTPUT if set.
+"""
+
+import json
+import logging
+import os
+import time
+import unittest
+
+from . import common
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK = os.environ.get('PACKAGE_HIERARCHY_BENCHMARK')
+BENCHMARK_OUTPUT = os.environ.get('PACKAGE_HIERARCHY_BENCHMARK_OUTPUT')
+
+# (depth, fan out, quants per package of the lowest level)
+DEFAULT_SCENARIOS = [(2, 10, 1), (3, 10, 1), (3, 20, 2)]
+
+
+def get_scenarios():
+    """ Return the scenarios given in PACKAGE_HIERARCHY_BENCHMARK, or the
+        default ones.
+    """
+    try:
+        return [tuple(int(n) for n in scenario.split(':'))
+                for scenario in BENCHMARK.split(',')]
+    except ValueError:
+        return DEFAULT_SCENARIOS
+
+
+@unittest.skipUnless(BENCHMARK, "PACKAGE_HIERARCHY_BENCHMARK is not set")
+class TestPackageHierarchyBenchmark(common.BaseHierarchy):
+    """Time and count the queries of the hierarchy operations."""
+
+    def measure(self, results, scenario, operation, func):
+        """ Run func, and add its duration and number of queries to results. """
+        cr = self.env.cr
+        queries = cr.sql_log_count
+        start = time.perf_counter()
+        func()
+        depth, fan_out, quants = scenario
+        result = {
+            'operation': operation,
+            'depth': depth,
+            'fan_out': fan_out,
+            'quants_per_package': quants,
+            'seconds': round(time.perf_counter() - start, 6),
+            'queries': cr.sql_log_count - queries,
+        }
+        _logger.info('Benchmark: %s', json.dumps(result, sort_keys=True))
+        results.append(result)
+
+    def run_scenario(self, scenario):
+        """ Build a hierarchy, move it with a picking and return the
+            measures of each step.
+        """
+        depth, fan_out, quants = scenario
+        # a product per scenario, so that the stock of the previous ones is
+        # not reserved
+        product = self.create_product('Benchmark%dx%dx%d' % scenario)
+        levels = self.create_hierarchy(depth, fan_out, quants,
+                                       self.test_location_02, product)
+        packages = self.env['stock.quant.package'].union(*levels)
+        root = levels[0]
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(product, len(levels[-1]) * quants, picking)
+        picking.action_confirm()
+        picking.action_assign()
+        self.env.invalidate_all()
+
+        results = []
+        self.measure(results, scenario, 'compute_parent_ids',
+                     packages._compute_parent_ids)
+        self.measure(results, scenario, 'compute_children_quant_ids',
+                     root._compute_children_quant_ids)
+        self.measure(results, scenario, 'compute_entire_package_ids',
+                     picking._compute_entire_package_ids)
+        self.measure(results, scenario, 'action_toggle_processed',
+                     root.with_context(picking_id=picking.id).action_toggle_processed)
+        # action_assign already set the result parents, clear them so that
+        # they are computed again
+        for ml in picking.move_line_ids:
+            ml.write({'result_package_id': ml.package_id.id,
+                      'u_result_parent_package_id': False})
+        self.env.invalidate_all()
+        self.measure(results, scenario, 'set_u_result_parent_package_id',
+                     picking._set_u_result_parent_package_id)
+        self.env.invalidate_all()
+        self.measure(results, scenario, 'action_done',
+                     picking.move_line_ids._action_done)
+        return results
+
+    def test_benchmark(self):
+        """Benchmark the hierarchy operations on synthetic hierarchies."""
+        results = []
+        for scenario in get_scenarios():
+            with self.subTest(scenario=scenario):
+                results.extend(self.run_scenario(scenario))
+        if BENCHMARK_OUTPUT:
+            with open(BENCHMARK_OUTPUT, 'a') as output:
+                for result in results:
+                    output.write(json.dumps(result, sort_keys=True) + '\n')
@@ -1,8 +1,9 @@
 """Test odoo-package-hierarchy"""
 
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
 
 from . import common
+from ..models.stock_quant_package import _tree_cache_dirty
 
 # Note that quant actually is being used; action_assign finds it.
 class TestPackageHierarchy(common.BaseHierarchy):
@@ -72,6 +73,48 @@ class TestPackageHierarchy(common.BaseHierarchy):
         with self.assertRaises(ValidationError):
             package2.package_id = self.pallet
 
+    def test_check_not_multi_location_reports_all(self):
+        """Make sure every multi-location package of a tree is reported."""
+        Package = self.env['stock.quant.package']
+        box = Package.create({})
+        self.package.package_id = self.pallet
+        box.package_id = self.package
+        # Add stock at another location, bypassing the constraints
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          3, package_id=box.id)
+        self.assertEqual(set(box._get_multi_location_packages()),
+                         {self.pallet.id, self.package.id})
+        with self.assertRaises(ValidationError):
+            box._check_not_multi_location()
+
+    def test_deferred_hierarchy_checks(self):
+        """Make sure deferred checks validate the trees when leaving the block."""
+        Package = self.env['stock.quant.package']
+        package2 = Package.create({})
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          11, package_id=package2.id)
+        with self.assertRaises(ValidationError):
+            with Package._deferred_hierarchy_checks():
+                self.package.package_id = self.pallet
+                # Not checked yet
+                package2.package_id = self.pallet
+        package2.package_id = False
+
+        with Package._deferred_hierarchy_checks():
+            self.package.package_id = self.pallet
+            package2.package_id = self.pallet
+            # Fixed before the end of the block
+            package2.package_id = False
+        self.assertEqual(self.pallet.children_ids, self.package)
+
+    def test_compute_does_not_check_multi_location(self):
+        """Make sure reading the hierarchy does not validate it."""
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          11, package_id=self.package.id)
+        self.package.invalidate_cache()
+        self.assertEqual(len(self.package.children_quant_ids), 2)
+        self.assertEqual(self.package.parent_ids, self.package)
+
     def test_compute_package_info(self):
         """Make sure _compute_package_info runs on both packages and pallets."""
         # This just runs the code for coverage. Checking the logic would only
@@ -80,6 +123,23 @@ class TestPackageHierarchy(common.BaseHierarchy):
         self.package.package_id = self.pallet
         self.pallet._compute_package_info()
 
+    def test_package_info_stored(self):
+        """Make sure the location of parent packages follows their content."""
+        Package = self.env['stock.quant.package']
+        self.package.package_id = self.pallet
+        self.assertEqual(self.package.location_id, self.test_location_01)
+        self.assertEqual(self.pallet.location_id, self.test_location_01)
+        self.assertEqual(
+            Package.search([('location_id', '=', self.test_location_01.id),
+                            ('id', 'in', (self.package | self.pallet).ids)]),
+            self.package | self.pallet)
+
+        self.quant.location_id = self.test_location_02
+        self.assertEqual(self.pallet.location_id, self.test_location_02)
+
+        self.package.package_id = False
+        self.assertFalse(self.pallet.location_id)
+
     def test_compute_display_name(self):
         """Make sure _compute_display_name runs on both packages and pallets."""
         self.package._compute_display_name()
@@ -113,6 +173,29 @@ class TestPackageHierarchy(common.BaseHierarchy):
         self.assertFalse(self.package.is_all_contents_in(outside_quant))
         self.assertFalse(other_package.is_all_contents_in(self.quant))
 
+    def test_filter_all_contents_in(self):
+        """Check filter_all_contents_in on several packages at once."""
+        Package = self.env['stock.quant.package']
+        package1 = Package.create({'package_id': self.pallet.id})
+        package2 = Package.create({'package_id': self.pallet.id})
+        other_pallet = Package.create({})
+        package3 = Package.create({'package_id': other_pallet.id})
+        pallets = self.pallet | other_pallet
+
+        self.assertEqual(pallets.filter_all_contents_in(package1 | package2),
+                         self.pallet)
+        self.assertEqual(pallets.filter_all_contents_in(package1 | package3),
+                         other_pallet)
+        self.assertFalse(pallets.filter_all_contents_in(package1))
+
+        quant3 = self.create_quant(self.apple.id, self.test_location_01.id,
+                                   5, package_id=package3.id)
+        self.assertEqual(pallets.filter_all_contents_in(quant3), pallets)
+        self.assertEqual((self.package | other_pallet).filter_all_contents_in(quant3),
+                         other_pallet)
+        with self.assertRaises(ValidationError):
+            pallets.filter_all_contents_in(self.picking)
+
     def test_compute_current_picking_info(self):
         """Test _compute_current_picking_info.
 
@@ -148,6 +231,135 @@ class TestPackageHierarchy(common.BaseHierarchy):
                          expectedDestination)
         self.assertFalse(self.pallet.is_processed)
 
+    def test_compute_current_picking_info_nested(self):
+        """Test _compute_current_picking_info on a pallet of cases of boxes."""
+        Package = self.env['stock.quant.package']
+        case = Package.create({'package_id': self.pallet.id})
+        box1 = Package.create({'package_id': case.id})
+        box2 = Package.create({'package_id': case.id})
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          7, package_id=box1.id)
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          8, package_id=box2.id)
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(self.apple, 15, picking)
+        picking.action_confirm()
+        picking.action_assign()
+
+        packages = (self.pallet | case | box1 | box2).with_context(
+            {'picking_id': picking.id})
+        packages._compute_current_picking_info()
+        pallet, case = packages[0], packages[1]
+
+        self.assertEqual(len(case.current_picking_move_line_ids), 2)
+        self.assertEqual(pallet.current_picking_move_line_ids,
+                         case.current_picking_move_line_ids)
+        self.assertTrue(pallet.current_picking_id)
+        self.assertEqual(pallet.current_source_location_id,
+                         self.test_location_02)
+        self.assertFalse(pallet.is_processed)
+
+    def test_compute_entire_package_ids_multi_level(self):
+        """Test that a fully contained pallet is promoted over two levels."""
+        Package = self.env['stock.quant.package']
+        case = Package.create({'package_id': self.pallet.id})
+        box1 = Package.create({'package_id': case.id})
+        box2 = Package.create({'package_id': case.id})
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          7, package_id=box1.id)
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          8, package_id=box2.id)
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(self.apple, 15, picking)
+        picking.action_confirm()
+        picking.action_assign()
+
+        self.assertEqual(picking.entire_package_ids,
+                         box1 | box2 | case | self.pallet)
+
+        # With one box left behind, neither the case nor the pallet is entire
+        box3 = Package.create({'package_id': case.id})
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          1, package_id=box3.id)
+        picking._compute_entire_package_ids()
+        self.assertEqual(picking.entire_package_ids, box1 | box2)
+
+    def test_set_u_result_parent_package_id_nested(self):
+        """Test result parents when a pallet holds quants and nested packages."""
+        Package = self.env['stock.quant.package']
+        case1 = Package.create({'package_id': self.pallet.id})
+        case2 = Package.create({'package_id': self.pallet.id})
+        box = Package.create({'package_id': case2.id})
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          7, package_id=case1.id)
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          8, package_id=box.id)
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(self.apple, 15, picking)
+        picking.action_confirm()
+        picking.action_assign()
+        for ml in picking.move_line_ids:
+            ml.result_package_id = ml.package_id
+
+        picking._set_u_result_parent_package_id()
+        case1_ml = picking.move_line_ids.filtered(lambda ml: ml.package_id == case1)
+        box_ml = picking.move_line_ids.filtered(lambda ml: ml.package_id == box)
+        # case2 is not a result package but its whole content moves, so
+        # the pallet is moved entirely
+        self.assertEqual(case1_ml.u_result_parent_package_id, self.pallet)
+        self.assertEqual(box_ml.u_result_parent_package_id, case2)
+
+    def test_set_u_result_parent_package_id_other_parent(self):
+        """Test a pallet is not moved entirely when a box goes elsewhere."""
+        Package = self.env['stock.quant.package']
+        other_pallet = Package.create({})
+        box1 = Package.create({'package_id': self.pallet.id})
+        box2 = Package.create({'package_id': self.pallet.id})
+        for box in box1 | box2:
+            self.create_quant(self.apple.id, self.test_location_02.id,
+                              5, package_id=box.id)
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(self.apple, 10, picking)
+        picking.action_confirm()
+        picking.action_assign()
+        # action_assign already put both boxes back in the pallet, start
+        # from lines without result parent instead
+        for ml in picking.move_line_ids:
+            ml.write({'result_package_id': ml.package_id.id,
+                      'u_result_parent_package_id': False})
+        box1_ml = picking.move_line_ids.filtered(lambda ml: ml.package_id == box1)
+        box2_ml = picking.move_line_ids.filtered(lambda ml: ml.package_id == box2)
+        box1_ml.u_result_parent_package_id = other_pallet
+
+        picking._set_u_result_parent_package_id()
+        self.assertEqual(box1_ml.u_result_parent_package_id, other_pallet)
+        self.assertFalse(box2_ml.u_result_parent_package_id)
+
+    def test_set_u_result_parent_package_id_batches(self):
+        """Test result parents are the same when processed in batches."""
+        Package = self.env['stock.quant.package']
+        other_pallet = Package.create({})
+        box1 = Package.create({'package_id': self.pallet.id})
+        box2 = Package.create({'package_id': self.pallet.id})
+        box3 = Package.create({'package_id': other_pallet.id})
+        for box in box1 | box2 | box3:
+            self.create_quant(self.apple.id, self.test_location_02.id,
+                              5, package_id=box.id)
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(self.apple, 15, picking)
+        picking.action_confirm()
+        picking.action_assign()
+        # action_assign already set the result parents without batches
+        for ml in picking.move_line_ids:
+            ml.write({'result_package_id': ml.package_id.id,
+                      'u_result_parent_package_id': False})
+
+        picking = picking.with_context(package_hierarchy_batch_size=1)
+        batches = picking.move_line_ids._get_root_package_batches()
+        self.assertEqual(len(batches), 2)
+        picking._set_u_result_parent_package_id()
+        for ml in picking.move_line_ids:
+            self.assertEqual(ml.u_result_parent_package_id, ml.package_id.package_id)
 
     def test_action_toggle_processed_no_picking(self):
         """Test action_toggle_processed with no picking"""
@@ -179,6 +391,28 @@ class TestPackageHierarchy(common.BaseHierarchy):
         pallet = pallet.with_context({'picking_id': picking.id})
         pallet.action_toggle_processed()
 
+    def test_action_toggle_processed_many_packages(self):
+        """Test action_toggle_processed on several packages at once."""
+        Package = self.env['stock.quant.package']
+        package1 = Package.create({})
+        package2 = Package.create({})
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          7, package_id=package1.id)
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          8, package_id=package2.id)
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(self.apple, 15, picking)
+        picking.action_confirm()
+        picking.action_assign()
+
+        packages = (package1 | package2).with_context({'picking_id': picking.id})
+        packages.action_toggle_processed()
+        for ml in picking.move_line_ids:
+            self.assertEqual(ml.qty_done, ml.product_uom_qty)
+        packages.invalidate_cache()
+        packages.action_toggle_processed()
+        self.assertEqual(picking.move_line_ids.mapped('qty_done'), [0, 0])
+
     def test_action_toggle_processed_with_dest(self):
         """Test action_toggle_processed with enough items to move."""
         self.package.package_id = self.pallet
@@ -194,6 +428,36 @@ class TestPackageHierarchy(common.BaseHierarchy):
             move.quantity_done = move.product_uom_qty
         ml._action_done()
 
+    def test_action_done_batched_parents(self):
+        """Check that _action_done re-parents and detaches result packages"""
+        Package = self.env['stock.quant.package']
+        package1 = Package.create({})
+        package2 = Package.create({})
+        other_pallet = Package.create({})
+        package2.package_id = other_pallet
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          7, package_id=package1.id)
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          8, package_id=package2.id)
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(self.apple, 15, picking)
+        picking.action_confirm()
+        picking.action_assign()
+        # action_assign already set the parent of package2, which is alone
+        # in other_pallet, as its result parent: detach it instead
+        for ml in picking.move_line_ids:
+            ml.write({'result_package_id': ml.package_id.id,
+                      'u_result_parent_package_id': False,
+                      'qty_done': ml.product_uom_qty})
+        package1_ml = picking.move_line_ids.filtered(lambda ml: ml.package_id == package1)
+        package1_ml.u_result_parent_package_id = self.pallet
+        for move in picking.move_lines:
+            move.quantity_done = move.product_uom_qty
+        picking.move_line_ids._action_done()
+
+        self.assertEqual(package1.package_id, self.pallet)
+        self.assertFalse(package2.package_id)
+
     def testOnchangeResultPackage(self):
         """test onchange_result_package"""
         ml = self.picking.move_line_ids[0]
@@ -229,6 +493,25 @@ class TestPackageHierarchy(common.BaseHierarchy):
         with self.assertRaises(ValidationError):
             picking.move_line_ids[0].u_result_parent_package_id = self.pallet
 
+    def test_assert_one_parent_package_same_parent(self):
+        """_assert_one_parent_package: move lines can share a result parent"""
+        Package = self.env['stock.quant.package']
+        package1 = Package.create({})
+        self.create_quant(self.apple.id, self.test_location_02.id,
+                          7, package_id=package1.id)
+        self.create_quant(self.banana.id, self.test_location_02.id,
+                          8, package_id=package1.id)
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(self.apple, 7, picking)
+        self.create_move(self.banana, 8, picking)
+        picking.action_confirm()
+        picking.action_assign()
+
+        picking.move_line_ids.write({'result_package_id': package1.id,
+                                     'u_result_parent_package_id': self.pallet.id})
+        self.assertEqual(picking.move_line_ids.mapped('u_result_parent_package_id'),
+                         self.pallet)
+
 
 class TestPackageInheritance(common.BaseHierarchy):
     """Tests for inheritance and recursion."""
@@ -279,3 +562,443 @@ class TestPackageInheritance(common.BaseHierarchy):
         self.package_2.write({"package_id": self.package_3.id})
         with self.assertRaises(ValidationError):
             self.package_1.write({"children_ids": [(4, self.package_3.id, False)]})
+
+    def test_nest_packages(self):
+        """Test that nest_packages sets many parents at once."""
+        Package = self.env["stock.quant.package"]
+        pallet = Package.create({})
+        boxes = Package.create({}) | Package.create({}) | Package.create({})
+        Package.nest_packages({
+            boxes[0].id: self.package_1.id,
+            boxes[1].id: self.package_1.id,
+            boxes[2].id: pallet.id,
+            self.package_1.id: pallet.id,
+        })
+        self.assertEqual(self.package_1.children_ids, boxes[:2])
+        self.assertEqual(pallet.children_ids, boxes[2] | self.package_1)
+        self.assertEqual(boxes[0].parent_ids, pallet | self.package_1 | boxes[0])
+
+        Package.nest_packages({boxes[0].id: False})
+        self.assertFalse(boxes[0].package_id)
+
+    def test_nest_packages_swap(self):
+        """Test nest_packages with a child taking the place of its parent."""
+        Package = self.env["stock.quant.package"]
+        self.package_2.package_id = self.package_1
+        Package.nest_packages({
+            self.package_1.id: self.package_2.id,
+            self.package_2.id: False,
+        })
+        self.assertFalse(self.package_2.package_id)
+        self.assertEqual(self.package_1.package_id, self.package_2)
+
+    def test_nest_packages_reports_all_violations(self):
+        """Test that nest_packages reports every violation and changes nothing."""
+        Package = self.env["stock.quant.package"]
+        self.package_2.package_id = self.package_1
+        self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                          package_id=self.package_2.id)
+        other = Package.create({})
+        self.create_quant(self.apple.id, self.test_location_02.id, 5,
+                          package_id=other.id)
+        with self.assertRaises(ValidationError) as e:
+            Package.nest_packages({
+                # cycles
+                self.package_1.id: self.package_2.id,
+                self.package_3.id: self.package_3.id,
+                # multi-location
+                other.id: self.package_1.id,
+            })
+        message = e.exception.name
+        self.assertIn(self.package_1.name, message)
+        self.assertIn(self.package_3.name, message)
+        self.assertIn("multiple locations", message)
+        self.assertFalse(other.package_id)
+        self.assertFalse(self.package_3.package_id)
+
+
+class TestPackageParentPath(common.BasePackageTree):
+    """Tests for the parent_path hierarchy index."""
+
+    def test_parent_path_on_create(self):
+        """Test that parent_path is set when creating packages."""
+        self.assertEqual(self.pallet.parent_path, self.path(self.pallet))
+        self.assertEqual(self.case.parent_path, self.path(self.pallet, self.case))
+        self.assertEqual(self.box.parent_path,
+                         self.path(self.pallet, self.case, self.box))
+
+    def test_parent_path_on_reparent(self):
+        """Test that moving a package updates the path of its whole subtree."""
+        Package = self.env["stock.quant.package"]
+        other_pallet = Package.create({})
+        self.case.package_id = other_pallet
+        self.assertEqual(self.case.parent_path, self.path(other_pallet, self.case))
+        self.assertEqual(self.box.parent_path,
+                         self.path(other_pallet, self.case, self.box))
+        self.assertEqual(self.pallet.parent_path, self.path(self.pallet))
+
+        self.case.package_id = False
+        self.assertEqual(self.box.parent_path, self.path(self.case, self.box))
+
+    def test_parent_path_on_nested_reparent(self):
+        """Test moving a package together with one of its descendants."""
+        Package = self.env["stock.quant.package"]
+        other_pallet = Package.create({})
+        (self.case | self.box).write({"package_id": other_pallet.id})
+        self.assertEqual(self.case.parent_path, self.path(other_pallet, self.case))
+        self.assertEqual(self.box.parent_path, self.path(other_pallet, self.box))
+
+        (self.case | self.box).write({"package_id": False})
+        self.assertEqual(self.case.parent_path, self.path(self.case))
+        self.assertEqual(self.box.parent_path, self.path(self.box))
+
+    def test_parent_path_compute(self):
+        """Test that missing parent paths are filled in by the backfill."""
+        Package = self.env["stock.quant.package"]
+        packages = self.pallet | self.case | self.box
+        self.env.cr.execute(
+            "UPDATE stock_quant_package SET parent_path = NULL WHERE id IN %s",
+            (tuple(packages.ids),))
+        Package._parent_path_compute(batch_size=1)
+        self.assertEqual(self.box.parent_path,
+                         self.path(self.pallet, self.case, self.box))
+
+    def test_descendant_lookup(self):
+        """Test ancestor and descendant lookups through parent_path."""
+        Package = self.env["stock.quant.package"]
+        self.assertEqual(self.box.parent_ids, self.pallet | self.case | self.box)
+        descendants = Package.search(self.pallet._get_descendant_domain())
+        self.assertEqual(descendants, self.pallet | self.case | self.box)
+        quant = self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                                  package_id=self.box.id)
+        self.assertEqual(self.pallet.children_quant_ids, quant)
+
+    def test_children_quant_ids_batch(self):
+        """Test that children_quant_ids is computed for a whole recordset."""
+        Package = self.env["stock.quant.package"]
+        other_box = Package.create({"package_id": self.case.id})
+        box_quant = self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                                      package_id=self.box.id)
+        other_quant = self.create_quant(self.banana.id, self.test_location_01.id, 3,
+                                        package_id=other_box.id)
+        packages = self.pallet | self.case | self.box | other_box
+        packages._compute_children_quant_ids()
+        self.assertEqual(self.pallet.children_quant_ids, box_quant | other_quant)
+        self.assertEqual(self.case.children_quant_ids, box_quant | other_quant)
+        self.assertEqual(self.box.children_quant_ids, box_quant)
+        self.assertEqual(other_box.children_quant_ids, other_quant)
+
+
+class TestPackageRollups(common.BasePackageTree):
+    """Tests for the rolled-up contents and root package of packages."""
+
+    def test_rollups(self):
+        """Test the rolled-up contents are kept current incrementally."""
+        Package = self.env["stock.quant.package"]
+        quant = self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                                  package_id=self.box.id)
+        self.create_quant(self.banana.id, self.test_location_01.id, 3,
+                          package_id=self.case.id)
+        self.assertEqual(self.pallet.u_quant_count, 2)
+        self.assertEqual(self.pallet.u_descendant_count, 2)
+        self.assertEqual(self.case.u_quant_count, 2)
+        self.assertEqual(self.box.u_quant_count, 1)
+        self.assertEqual((self.pallet.u_depth, self.case.u_depth, self.box.u_depth),
+                         (0, 1, 2))
+        contents = {c.product_id: c.quantity for c in self.pallet.u_content_ids}
+        self.assertEqual(contents, {self.apple: 5, self.banana: 3})
+
+        quant.quantity = 8
+        contents = {c.product_id: c.quantity for c in self.pallet.u_content_ids}
+        self.assertEqual(contents, {self.apple: 8, self.banana: 3})
+
+        other_pallet = Package.create({})
+        self.case.package_id = other_pallet
+        self.assertEqual(self.pallet.u_quant_count, 0)
+        self.assertEqual(self.pallet.u_descendant_count, 0)
+        self.assertFalse(self.pallet.u_content_ids)
+        self.assertEqual(other_pallet.u_quant_count, 2)
+        self.assertEqual(other_pallet.u_descendant_count, 2)
+        self.assertEqual(self.box.u_depth, 2)
+
+        quant.unlink()
+        self.assertEqual(other_pallet.u_quant_count, 1)
+        self.assertEqual(other_pallet.u_content_ids.product_id, self.banana)
+
+        # A full recomputation gives the same results
+        Package._rollup_compute()
+        self.assertEqual(other_pallet.u_quant_count, 1)
+        self.assertEqual(other_pallet.u_descendant_count, 2)
+        self.assertEqual(other_pallet.u_content_ids.quantity, 3)
+
+    def test_rollups_nested_reparent(self):
+        """Test the rollups when a package is moved along with its child."""
+        Package = self.env["stock.quant.package"]
+        self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                          package_id=self.box.id)
+        self.create_quant(self.banana.id, self.test_location_01.id, 3,
+                          package_id=self.case.id)
+        other_pallet = Package.create({})
+        (self.case | self.box).write({"package_id": other_pallet.id})
+
+        self.assertEqual(self.pallet.u_quant_count, 0)
+        self.assertEqual(self.pallet.u_descendant_count, 0)
+        self.assertFalse(self.pallet.u_content_ids)
+        self.assertEqual(self.case.u_quant_count, 1)
+        self.assertEqual(self.case.u_descendant_count, 0)
+        self.assertEqual(self.case.u_content_ids.product_id, self.banana)
+        self.assertEqual(other_pallet.u_quant_count, 2)
+        self.assertEqual(other_pallet.u_descendant_count, 2)
+        contents = {c.product_id: c.quantity for c in other_pallet.u_content_ids}
+        self.assertEqual(contents, {self.apple: 5, self.banana: 3})
+
+    def test_root_package(self):
+        """Test the root package of quants follows the hierarchy."""
+        Package = self.env["stock.quant.package"]
+        Quant = self.env["stock.quant"]
+        box_quant = self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                                      package_id=self.box.id)
+        case_quant = self.create_quant(self.banana.id, self.test_location_01.id, 3,
+                                       package_id=self.case.id)
+        loose_quant = self.create_quant(self.banana.id, self.test_location_01.id, 2)
+        self.assertEqual(box_quant.u_root_package_id, self.pallet)
+        self.assertEqual(case_quant.u_root_package_id, self.pallet)
+        self.assertFalse(loose_quant.u_root_package_id)
+
+        other_pallet = Package.create({})
+        self.case.package_id = other_pallet
+        self.assertEqual(box_quant.u_root_package_id, other_pallet)
+        self.assertEqual(case_quant.u_root_package_id, other_pallet)
+
+        loose_quant.package_id = self.pallet
+        self.assertEqual(loose_quant.u_root_package_id, self.pallet)
+
+        groups = Quant.read_group(
+            [('id', 'in', (box_quant | case_quant | loose_quant).ids)],
+            ['u_root_package_id', 'quantity'], ['u_root_package_id'])
+        quantities = {g['u_root_package_id'][0]: g['quantity'] for g in groups}
+        self.assertEqual(quantities, {other_pallet.id: 8, self.pallet.id: 2})
+
+    def test_root_package_create_with_quants(self):
+        """Test creating a package along with its quants."""
+        Package = self.env["stock.quant.package"]
+        quant = self.create_quant(self.apple.id, self.test_location_01.id, 5)
+        package = Package.create({"package_id": self.case.id,
+                                  "quant_ids": [(4, quant.id)]})
+        self.assertEqual(quant.package_id, package)
+        self.assertEqual(quant.u_root_package_id, self.pallet)
+        self.assertEqual(package.parent_path,
+                         self.path(self.pallet, self.case, package))
+        self.assertEqual(package.u_quant_count, 1)
+        self.assertEqual(self.pallet.u_quant_count, 1)
+        self.assertEqual(self.pallet.u_content_ids.quantity, 5)
+
+
+class TestPackageTreeStock(common.BasePackageTree):
+    """Tests for moving and reserving whole package trees."""
+
+    def test_move_package_tree(self):
+        """Test moving a whole pallet at once keeps the stock history."""
+        MoveLine = self.env["stock.move.line"]
+        box_quant = self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                                      package_id=self.box.id)
+        case_quant = self.create_quant(self.banana.id, self.test_location_01.id, 3,
+                                       package_id=self.case.id)
+        empty_box = self.env["stock.quant.package"].create(
+            {'package_id': self.case.id})
+        moves = self.pallet.move_package_tree(self.test_location_02.id)
+
+        self.assertEqual(len(moves), 2)
+        self.assertEqual(set(moves.mapped('state')), {'done'})
+        self.assertEqual((box_quant | case_quant).mapped('location_id'),
+                         self.test_location_02)
+        for package in self.pallet | self.case | self.box:
+            self.assertEqual(package.location_id, self.test_location_02)
+        # Empty packages are not given a location
+        self.assertFalse(empty_box.location_id)
+        move_lines = MoveLine.search([('move_id', 'in', moves.ids)])
+        self.assertEqual(len(move_lines), 2)
+        box_ml = move_lines.filtered(lambda ml: ml.package_id == self.box)
+        self.assertEqual(box_ml.qty_done, 5)
+        self.assertEqual(box_ml.result_package_id, self.box)
+        self.assertEqual(box_ml.location_dest_id, self.test_location_02)
+        self.assertEqual(box_ml.state, 'done')
+
+        # Only top-level packages can be moved
+        with self.assertRaises(UserError):
+            self.case.move_package_tree(self.test_location_01.id)
+
+    def test_reserve_whole_packages(self):
+        """Test whole packages are reserved before loose quants."""
+        self.picking_type_internal.u_reserve_whole_packages = True
+        self.create_quant(self.apple.id, self.test_location_01.id, 4)
+        self.create_quant(self.apple.id, self.test_location_01.id, 6,
+                          package_id=self.box.id)
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(self.apple, 6, picking)
+        picking.action_assign()
+
+        move_line = picking.move_line_ids
+        self.assertEqual(len(move_line), 1)
+        self.assertEqual(move_line.package_id, self.box)
+        self.assertEqual(move_line.product_uom_qty, 6)
+
+
+class TestPackageTreeLookup(common.BasePackageTree):
+    """Tests for resolving, naming and searching packages in a hierarchy."""
+
+    def test_get_package_tree(self):
+        """Test resolving a package name to its tree and contents."""
+        Package = self.env["stock.quant.package"]
+        self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                          package_id=self.box.id)
+        tree = Package.get_package_tree(self.case.name)
+        self.assertEqual(tree["id"], self.case.id)
+        self.assertEqual(tree["root"]["id"], self.pallet.id)
+        self.assertEqual([p["id"] for p in tree["ancestors"]], [self.pallet.id])
+        self.assertEqual([p["id"] for p in tree["descendants"]], [self.box.id])
+        self.assertEqual(tree["location_id"][0], self.test_location_01.id)
+        self.assertEqual(len(tree["contents"]), 1)
+        self.assertEqual(tree["contents"][0]["product_id"][0], self.apple.id)
+        self.assertEqual(tree["contents"][0]["quantity"], 5)
+
+        # A transaction that wrote in the hierarchy does not use the cache
+        queries = self.env.cr.sql_log_count
+        self.assertEqual(Package.get_package_tree(self.case.name), tree)
+        self.assertGreater(self.env.cr.sql_log_count, queries)
+
+        # Cached trees are not read again by clean transactions
+        other_pallet = Package.create({})
+        del _tree_cache_dirty[self.env.cr]
+        Package.get_package_tree(self.case.name)
+        other_tree = Package.get_package_tree(other_pallet.name)
+        queries = self.env.cr.sql_log_count
+        self.assertEqual(Package.get_package_tree(self.case.name), tree)
+        self.assertEqual(self.env.cr.sql_log_count, queries)
+
+        # Quant changes only drop the cached trees of their root package,
+        # without bypassing the cache for the rest of the transaction
+        self.create_quant(self.banana.id, self.test_location_01.id, 2,
+                          package_id=self.box.id)
+        self.assertNotIn(self.env.cr, _tree_cache_dirty)
+        queries = self.env.cr.sql_log_count
+        self.assertEqual(Package.get_package_tree(other_pallet.name), other_tree)
+        self.assertEqual(self.env.cr.sql_log_count, queries)
+        tree = Package.get_package_tree(self.case.name)
+        self.assertEqual(len(tree["contents"]), 2)
+        self.assertFalse(Package.get_package_tree("no such package"))
+
+        # Package writes drop the cached trees and bypass the cache
+        self.box.name = "Renamed box"
+        self.assertIn(self.env.cr, _tree_cache_dirty)
+        tree = Package.get_package_tree(self.case.name)
+        self.assertEqual(tree["descendants"][0]["name"], "Renamed box")
+
+    def test_get_children_page(self):
+        """Test paginating the direct content of a package."""
+        Package = self.env["stock.quant.package"]
+        boxes = self.box | Package.create({"package_id": self.case.id})
+        quant = self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                                  package_id=self.case.id)
+        self.create_quant(self.banana.id, self.test_location_01.id, 3,
+                          package_id=self.box.id)
+
+        page = self.case.get_children_page(limit=2)
+        self.assertEqual(page["child_count"], 2)
+        self.assertEqual(page["direct_quant_count"], 1)
+        self.assertEqual(page["quant_count"], 2)
+        self.assertEqual(set(c["id"] for c in page["children"]), set(boxes.ids))
+        self.assertEqual(page["quants"], [])
+
+        page = self.case.get_children_page(offset=2, limit=2)
+        self.assertEqual(page["children"], [])
+        self.assertEqual([q["id"] for q in page["quants"]], [quant.id])
+
+    def test_browse_children(self):
+        """Test browsing the content of a package page by page."""
+        Browser = self.env["package.hierarchy.browser"]
+        Package = self.env["stock.quant.package"]
+        Package.create({"package_id": self.case.id})
+        quant = self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                                  package_id=self.case.id)
+
+        action = self.case.action_view_children()
+        browser = Browser.browse(action["res_id"])
+        self.assertEqual(browser.package_id, self.case)
+        self.assertEqual(browser.child_count, 2)
+        self.assertEqual(browser.direct_quant_count, 1)
+        self.assertEqual(len(browser.line_ids), 3)
+        self.assertFalse(browser.has_next)
+
+        browser = Browser.browse(Browser.open_package(self.case.id, limit=2)["res_id"])
+        self.assertEqual(len(browser.line_ids.filtered("child_package_id")), 2)
+        self.assertTrue(browser.has_next)
+        browser.action_next_page()
+        self.assertEqual(browser.line_ids.mapped("product_id"), quant.product_id)
+        self.assertTrue(browser.has_previous)
+
+        box_line = Browser.browse(action["res_id"]).line_ids.filtered(
+            lambda l: l.child_package_id == self.box)
+        browser = Browser.browse(box_line.action_expand()["res_id"])
+        self.assertEqual(browser.package_id, self.box)
+        browser = Browser.browse(browser.action_parent()["res_id"])
+        self.assertEqual(browser.package_id, self.case)
+
+    def test_full_name(self):
+        """Test the full name follows renames and moves of the ancestors."""
+        Package = self.env["stock.quant.package"]
+        self.pallet.name = "PALLET"
+        self.case.name = "CASE"
+        self.box.name = "BOX"
+        self.assertEqual(self.box.u_full_name, "PALLET/CASE/BOX")
+        self.assertEqual(self.box.display_name, "PALLET/CASE/BOX")
+
+        self.pallet.name = "PALLET2"
+        self.assertEqual(self.box.u_full_name, "PALLET2/CASE/BOX")
+
+        self.case.package_id = False
+        self.assertEqual(self.box.u_full_name, "CASE/BOX")
+        self.assertEqual(self.case.name_get(), [(self.case.id, "CASE")])
+
+        result = Package.name_search("CASE/BO")
+        self.assertEqual(result, [(self.box.id, "CASE/BOX")])
+
+    def test_search_hierarchy(self):
+        """Test searching packages and quants anywhere in a hierarchy."""
+        Package = self.env["stock.quant.package"]
+        Quant = self.env["stock.quant"]
+        other_box = Package.create({})
+        quant = self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                                  package_id=self.box.id)
+        self.create_quant(self.apple.id, self.test_location_01.id, 5,
+                          package_id=other_box.id)
+
+        self.assertEqual(Package.search([("parent_ids", "=", self.pallet.id)]),
+                         self.pallet | self.case | self.box)
+        self.assertEqual(Package.search([("parent_ids", "ilike", self.case.name)]),
+                         self.case | self.box)
+        self.assertEqual(Package.search([("u_descendant_ids", "in", self.box.ids)]),
+                         self.pallet | self.case)
+        self.assertEqual(self.pallet.u_descendant_ids, self.case | self.box)
+        self.assertEqual(
+            Quant.search([("package_id.parent_ids", "=", self.pallet.id)]), quant)
+
+
+class TestPackageHierarchyInstrumentation(common.BasePackageTree):
+    """Tests for the instrumentation of the hierarchy methods."""
+
+    def test_instrumentation(self):
+        """Test the hierarchy methods are instrumented only when enabled."""
+        Stat = self.env["package.hierarchy.stat"]
+        Stat.action_reset_stats()
+        packages = self.pallet | self.case | self.box
+        packages._compute_parent_ids()
+        Stat.action_view_stats()
+        self.assertFalse(Stat.search([]))
+
+        packages.with_context(package_hierarchy_instrumentation=True)._compute_parent_ids()
+        Stat.action_view_stats()
+        stat = Stat.search([])
+        self.assertEqual(stat.method, "stock.quant.package._compute_parent_ids")
+        self.assertEqual(stat.call_count, 1)
+        self.assertEqual(stat.record_count, 3)
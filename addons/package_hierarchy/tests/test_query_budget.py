@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""Query budgets of the package hierarchy operations.
+
+Each operation is run on a small and a much larger hierarchy. Both runs
+have to stay within the budget of the operation, and the larger one must
+not run more queries than the smaller one, so that a number of queries
+growing with the number of packages, quants or move lines fails the tests.
+"""
+
+from . import common
+
+# (depth, fan out) of the hierarchies, with a quant per package of the
+# lowest level: 7 packages and 4 quants, then 73 packages and 64 quants
+SIZES = [(3, 2), (3, 8)]
+
+# Maximum number of queries per operation, whatever the size
+BUDGETS = {
+    '_compute_parent_ids': 5,
+    '_compute_children_quant_ids': 10,
+    '_compute_descendant_ids': 10,
+    'get_package_tree': 10,
+    '_compute_entire_package_ids': 25,
+    'action_toggle_processed': 60,
+    '_set_u_result_parent_package_id': 40,
+    '_set_result_package_parents': 60,
+}
+
+
+class TestPackageHierarchyQueryBudget(common.BaseHierarchy):
+    """Check the number of queries of the hierarchy operations."""
+
+    def setup_hierarchy(self, depth, fan_out):
+        """ Create a hierarchy in test location 02 and a picking reserving
+            all of it, and return the packages by level and the picking.
+        """
+        # a product per size, so that the stock of the other sizes is not
+        # reserved
+        product = self.create_product('Budget%dx%d' % (depth, fan_out))
+        levels = self.create_hierarchy(depth, fan_out, 1,
+                                       self.test_location_02, product)
+        picking = self.create_picking(self.picking_type_internal)
+        self.create_move(product, len(levels[-1]), picking)
+        picking.action_confirm()
+        picking.action_assign()
+        self.env.invalidate_all()
+        return levels, picking
+
+    def check_budget(self, method, func, prepare=None):
+        """ Run func(levels, picking) with the budget of method on each
+            size of hierarchy, after prepare(levels, picking) if given, and
+            check that the number of queries does not grow with the size.
+        """
+        counts = []
+        for depth, fan_out in SIZES:
+            levels, picking = self.setup_hierarchy(depth, fan_out)
+            if prepare:
+                prepare(levels, picking)
+                self.env.invalidate_all()
+            with self.assertQueryBudget(method, BUDGETS[method]) as result:
+                func(levels, picking)
+            counts.append(result['count'])
+        self.assertLessEqual(
+            counts[-1], counts[0],
+            "%s ran %d queries on the hierarchy of size %s, more than the %d "
+            "queries on the one of size %s" % (
+                method, counts[-1], SIZES[-1], counts[0], SIZES[0]))
+
+    def all_packages(self, levels):
+        return self.env['stock.quant.package'].union(*levels)
+
+    def test_compute_parent_ids(self):
+        """Test the query budget of _compute_parent_ids."""
+        self.check_budget('_compute_parent_ids', lambda levels, picking:
+                          self.all_packages(levels)._compute_parent_ids())
+
+    def test_compute_children_quant_ids(self):
+        """Test the query budget of _compute_children_quant_ids."""
+        self.check_budget('_compute_children_quant_ids', lambda levels, picking:
+                          self.all_packages(levels)._compute_children_quant_ids())
+
+    def test_compute_descendant_ids(self):
+        """Test the query budget of _compute_descendant_ids."""
+        self.check_budget('_compute_descendant_ids', lambda levels, picking:
+                          self.all_packages(levels)._compute_descendant_ids())
+
+    def test_get_package_tree(self):
+        """Test the query budget of get_package_tree."""
+        Package = self.env['stock.quant.package']
+
+        def get_package_tree(levels, picking):
+            Package._clear_tree_cache()
+            Package.get_package_tree(levels[1][0].name)
+
+        self.check_budget('get_package_tree', get_package_tree)
+
+    def test_compute_entire_package_ids(self):
+        """Test the query budget of _compute_entire_package_ids."""
+        self.check_budget('_compute_entire_package_ids', lambda levels, picking:
+                          picking._compute_entire_package_ids())
+
+    def test_action_toggle_processed(self):
+        """Test the query budget of action_toggle_processed."""
+        self.check_budget('action_toggle_processed', lambda levels, picking:
+                          levels[0].with_context(picking_id=picking.id)
+                          .action_toggle_processed())
+
+    def test_set_u_result_parent_package_id(self):
+        """Test the query budget of _set_u_result_parent_package_id."""
+
+        def set_result_packages(levels, picking):
+            # action_assign already set the result parents, clear them so
+            # that they are computed again
+            for ml in picking.move_line_ids:
+                ml.write({'result_package_id': ml.package_id.id,
+                          'u_result_parent_package_id': False})
+
+        self.check_budget('_set_u_result_parent_package_id',
+                          lambda levels, picking: picking._set_u_result_parent_package_id(),
+                          prepare=set_result_packages)
+
+    def test_set_result_package_parents(self):
+        """Test the query budget of the re-parenting of _action_done."""
+        Package = self.env['stock.quant.package']
+
+        def set_result_parents(levels, picking):
+            pallet = Package.create({})
+            for ml in picking.move_line_ids:
+                ml.write({'result_package_id': ml.package_id.id,
+                          'u_result_parent_package_id': pallet.id})
+
+        self.check_budget('_set_result_package_parents',
+                          lambda levels, picking: picking.move_line_ids._set_result_package_parents(),
+                          prepare=set_result_parents)